@@ -1,11 +1,13 @@
 import logging
 logging.basicConfig(level=logging.INFO)
-import asyncio, json, os, time, orm
+import asyncio, json, os, time, signal, orm, idgen
 from datetime import datetime
 from aiohttp import web
 from jinja2 import Environment, FileSystemLoader
-from config_default import configs
-from webframe import add_routes, add_static, logger_factory, response_factory, auth_factory
+from config import configs
+from model import User, Blog, Comment, Category, blog_views
+from search import blog_index, rebuild_blog_index, reconcile_blog_index
+from webframe import add_routes, add_static, logger_factory, response_factory, auth_factory, deadline_factory
 
 
 def init_jinja2(app, **kwargs):
@@ -44,12 +46,20 @@ def date_filter(t):
     return u'%s-%s-%s'%(dt.year, dt.month, dt.day)
 
 async def on_close(app):
+    # 先写回缓冲的浏览次数再关闭连接池
+    await blog_views.close()
+    await blog_index.close()
     await orm.close_pool()
 
 async def init(loop):
     rs = dict()
+    idgen.configure(**configs.ids)
     await orm.create_pool(loop, **configs.database)
-    app = web.Application(loop=loop, middlewares=[logger_factory, logger_factory, auth_factory])
+    await orm.rebuild_counters(User, Blog, Comment, Category)
+    blog_views.interval = configs.view_counter.interval
+    blog_views.start()
+    await blog_index.open(configs.search.path, rebuild_blog_index, configs.search.interval, reconcile_blog_index, configs.search.refresh)
+    app = web.Application(loop=loop, middlewares=[logger_factory, deadline_factory, auth_factory, response_factory])
     app.on_shutdown.append(on_close)
     init_jinja2(app, filters=dict(deltatime=deltatime_filter, date=date_filter))
     add_routes(app, 'handlers')
@@ -63,6 +73,8 @@ async def init(loop):
     return rs
 loop = asyncio.get_event_loop()
 rs = loop.run_until_complete(init(loop))
+# kill（SIGTERM）和Ctrl+C一样走下面的关闭流程，缓冲的浏览次数不会丢失
+loop.add_signal_handler(signal.SIGTERM, loop.stop)
 try:
     loop.run_forever()
 except KeyboardInterrupt:
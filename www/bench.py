@@ -0,0 +1,260 @@
+'''
+Benchmarks for the orm layer, run against the database configured in config/default.cfg (and user.cfg).
+
+Usage:
+    python3 bench.py save_many [rows]
+    python3 bench.py rows [rows]
+    python3 bench.py deferred [rows] [content_kb]
+    python3 bench.py ids [rows]
+    python3 bench.py pages [pages] [concurrency]
+    python3 bench.py decode [rows]
+'''
+import sys, time, asyncio, logging, tracemalloc
+import orm, idgen
+from config import configs
+from orm import Model, StringField, FloatField, TextField
+from model import next_id
+from webframe import gather_page
+
+__author__ = 'cjh'
+
+
+# 基准测试使用单独的表，不碰业务数据
+class BenchComment(Model):
+    __table__ = 'bench_comments'
+    __deferred__ = ()
+
+    id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
+    blog_id = StringField(ddl='varchar(50)')
+    user_id = StringField(ddl='varchar(50)')
+    user_name = StringField(ddl='varchar(50)')
+    user_image = StringField(ddl='varchar(500)')
+    content = TextField()
+    created_at = FloatField(default=time.time)
+
+
+# 与Blog一样，content默认延迟加载
+class BenchBlog(Model):
+    __table__ = 'bench_blogs'
+
+    id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
+    title = StringField(ddl='varchar(50)')
+    summary = StringField(ddl='varchar(200)')
+    content = TextField()
+    created_at = FloatField(default=time.time)
+
+
+# 主键生成器对比用的表，带一个二级索引（二级索引的每一项都包含主键）
+class BenchId(Model):
+    __table__ = 'bench_ids'
+    __indexes__ = (('blog_id', 'created_at'),)
+
+    id = StringField(primary_key=True, ddl='varchar(50)')
+    blog_id = StringField(ddl='varchar(50)')
+    created_at = FloatField(default=time.time)
+
+
+def make_comments(n):
+    return [BenchComment(blog_id='bench', user_id='bench', user_name='bench', user_image='', content='comment %d' % i) for i in range(n)]
+
+
+async def reset_table():
+    await orm.execute(orm.create_table_sql(BenchComment), None)
+    await orm.execute('delete from `bench_comments`', None)
+
+
+def report(name, n, seconds):
+    print('%-24s %8d rows %10.3f s %12.1f rows/s' % (name, n, seconds, n / seconds))
+
+
+async def bench_save_many(n=10000):
+    await reset_table()
+    comments = make_comments(n)
+    start = time.time()
+    for c in comments:
+        await c.save()
+    report('save() x %d' % n, n, time.time() - start)
+
+    await reset_table()
+    comments = make_comments(n)
+    start = time.time()
+    counts = await BenchComment.save_many(comments)
+    report('save_many()', n, time.time() - start)
+    print('affected rows per batch: %s' % counts)
+    await orm.execute('drop table `bench_comments`', None)
+
+
+# findall的结果常驻内存大小以及读取全部字段的耗时
+async def measure_findall(compact):
+    tracemalloc.start()
+    start = time.time()
+    rows = await BenchComment.findall(compact=compact)
+    load = time.time() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    start = time.time()
+    for _ in range(10):
+        for r in rows:
+            r.id, r.blog_id, r.user_id, r.user_name, r.user_image, r.content, r.created_at
+    access = time.time() - start
+    return len(rows), load, memory, access
+
+
+async def bench_rows(n=10000):
+    await reset_table()
+    await BenchComment.save_many(make_comments(n))
+    for name, compact in (('Model (dict)', False), ('Row (__slots__)', True)):
+        count, load, memory, access = await measure_findall(compact)
+        print('%-16s %6d rows  findall %7.3f s  memory %8.1f KB  10x attribute reads %7.3f s' % (name, count, load, memory / 1024.0, access))
+    await orm.execute('drop table `bench_comments`', None)
+
+
+# 列表查询跳过延迟字段前后，从数据库读取的字节数和耗时
+async def bench_deferred(n=1000, content_kb=20):
+    await orm.execute(orm.create_table_sql(BenchBlog), None)
+    await orm.execute('delete from `bench_blogs`', None)
+    content = 'x' * (content_kb * 1024)
+    await BenchBlog.save_many([BenchBlog(title='bench %d' % i, summary='summary %d' % i, content=content) for i in range(n)])
+    for name, undefer in (('all columns', True), ('deferred content', False)):
+        start = time.time()
+        rows = await BenchBlog.findall(orderBy='created_at desc', compact=True, undefer=undefer)
+        elapsed = time.time() - start
+        size = sum(len(str(v)) for r in rows for v in r.to_dict().values())
+        print('%-18s %6d rows  findall %7.3f s  %10.1f KB read' % (name, len(rows), elapsed, size / 1024.0))
+    await orm.execute('drop table `bench_blogs`', None)
+
+
+# 表的数据和索引占用的字节数
+async def table_size(model):
+    if orm.backend() == 'sqlite':
+        rs = await orm.select('select `m`.`type` _type_, sum(`s`.`pgsize`) _size_ from `dbstat` `s` join `sqlite_master` `m` on `s`.`name` = `m`.`name` '
+                              'where `m`.`tbl_name` = ? group by `m`.`type`', [model.__table__])
+        sizes = dict((r['_type_'], r['_size_']) for r in rs)
+        return sizes.get('table', 0), sizes.get('index', 0)
+    await orm.execute('analyze table `%s`' % model.__table__, None)
+    rs = await orm.select('select `data_length` _data_, `index_length` _index_ from information_schema.tables '
+                          'where `table_schema` = database() and `table_name` = ?', [model.__table__])
+    return rs[0]['_data_'], rs[0]['_index_']
+
+
+# 原来的uuid id和snowflake id的写入速度、表和索引大小
+async def bench_ids(n=100000):
+    for name, generator in (('uuid', idgen.UuidIds()), ('snowflake', idgen.SnowflakeIds())):
+        await orm.execute('drop table if exists `bench_ids`', None)
+        await orm.execute(orm.create_table_sql(BenchId), None)
+        if orm.backend() == 'sqlite':
+            for index in BenchId.__indexes__:
+                await orm.execute(orm.create_index_sql(BenchId, index), None)
+        start = time.time()
+        for i in range(0, n, 1000):
+            await BenchId.save_many([BenchId(id=generator(), blog_id='blog %d' % (j % 100)) for j in range(i, min(n, i + 1000))])
+        report('insert %s ids' % name, n, time.time() - start)
+        data, index = await table_size(BenchId)
+        print('%-24s data %10.1f KB  index %10.1f KB' % ('', data / 1024.0, index / 1024.0))
+    await orm.execute('drop table `bench_ids`', None)
+
+
+# 与博客详情页相同形状的查询：侧栏列表、博客本身、它的评论
+async def blog_page_sequential(blog_id):
+    await BenchBlog.findall(orderBy='created_at desc', limit=10, compact=True)
+    await BenchBlog.find(blog_id)
+    await BenchComment.findall(where='blog_id=?', args=[blog_id], orderBy='created_at desc', compact=True)
+
+async def blog_page_gathered(blog_id):
+    await gather_page(
+        recent=BenchBlog.findall(orderBy='created_at desc', limit=10, compact=True),
+        blog=BenchBlog.find(blog_id),
+        comments=BenchComment.findall(where='blog_id=?', args=[blog_id], orderBy='created_at desc', compact=True))
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+# 页面查询依次执行和并发执行时的单页耗时p50/p99，concurrency个客户端同时请求
+async def bench_pages(n=2000, concurrency=1):
+    await orm.execute(orm.create_table_sql(BenchBlog), None)
+    await reset_table()
+    await orm.execute('delete from `bench_blogs`', None)
+    blogs = [BenchBlog(title='bench %d' % i, summary='summary', content='x' * 2000) for i in range(100)]
+    await BenchBlog.save_many(blogs)
+    await BenchComment.save_many([BenchComment(blog_id=blogs[i % 100].id, user_id='bench', user_name='bench', user_image='', content='comment %d' % i) for i in range(2000)])
+    for name, page in (('sequential', blog_page_sequential), ('gather_page', blog_page_gathered)):
+        latencies = []
+        async def client(k):
+            for i in range(k, n, concurrency):
+                start = time.time()
+                await page(blogs[i % 100].id)
+                latencies.append(time.time() - start)
+        start = time.time()
+        await asyncio.gather(*[client(k) for k in range(concurrency)])
+        elapsed = time.time() - start
+        latencies.sort()
+        print('%-12s %6d pages  concurrency %3d  p50 %7.2f ms  p99 %7.2f ms  %8.1f pages/s'
+              % (name, n, concurrency, percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000, n / elapsed))
+    await orm.execute('drop table `bench_blogs`', None)
+    await orm.execute('drop table `bench_comments`', None)
+
+
+# 原来的解码方式：DictCursor每行一个dict，再用cls(**r)构造对象（Model还要带上自己的脏字段set）
+def dict_row_to_model(r):
+    obj = BenchComment(**r)
+    obj.__dict__['_dirty'] = set()
+    return obj
+
+async def findall_dict_rows(compact):
+    rs = await orm.select(BenchComment.__select__, None)
+    if compact:
+        return [BenchComment.__row__(**r) for r in rs]
+    return [dict_row_to_model(r) for r in rs]
+
+
+# 大结果集的findall：dict游标逐行构造与元组游标按语句形状解码的耗时和内存峰值
+async def bench_decode(n=100000):
+    await reset_table()
+    for i in range(0, n, 10000):
+        await BenchComment.save_many(make_comments(min(10000, n - i)))
+    for compact in (False, True):
+        for name, load in (('dict rows', lambda: findall_dict_rows(compact)), ('tuple rows', lambda: BenchComment.findall(compact=compact))):
+            await load()
+            tracemalloc.start()
+            start = time.time()
+            rows = await load()
+            elapsed = time.time() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            # 不开tracemalloc再测一次时间，tracemalloc本身会拖慢分配
+            start = time.time()
+            rows = await load()
+            print('%-10s %-8s %8d rows  findall %7.3f s  (traced %7.3f s)  peak %9.1f KB'
+                  % (name, 'Row' if compact else 'Model', len(rows), time.time() - start, elapsed, peak / 1024.0))
+    await orm.execute('drop table `bench_comments`', None)
+
+
+BENCHES = {
+    'save_many': bench_save_many,
+    'rows': bench_rows,
+    'deferred': bench_deferred,
+    'ids': bench_ids,
+    'pages': bench_pages,
+    'decode': bench_decode,
+}
+
+
+async def main(loop, name, args):
+    await orm.create_pool(loop, **configs.database)
+    try:
+        await BENCHES[name](*map(int, args))
+    finally:
+        await orm.close_pool()
+
+
+if __name__ == '__main__':
+    argv = sys.argv[1:]
+    if not argv or argv[0] not in BENCHES:
+        print('Usage: python3 bench.py %s [args]' % '|'.join(sorted(BENCHES)))
+        exit(0)
+    # 每条SQL都打INFO日志会严重干扰计时
+    logging.getLogger().setLevel(logging.WARNING)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(loop, argv[0], argv[1:]))
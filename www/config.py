@@ -28,10 +28,16 @@ def merge(default, override):
     r = {}
     for k, v in default.items():
         if k in override:
-            if isinstance(v, dict):
+            if isinstance(v, dict) and isinstance(override[k], dict):
                 r[k] = merge(v, override[k])
             else:
-                r[k] = v
+                r[k] = override[k]
+        else:
+            r[k] = v
+    # default里没有的可选配置项（如database.autosize）也要保留
+    for k, v in override.items():
+        if k not in default:
+            r[k] = v
     return r
 
 # 把配置文件转换为Dict类实例
@@ -54,7 +60,7 @@ with open(path + '/default.cfg', 'r') as fp:
         if line.strip().startswith('//'):
             continue
         s += line.strip()
-    configs = json.loads()
+    configs = json.loads(s)
 
 # try:
 #     import config_override
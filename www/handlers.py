@@ -1,31 +1,35 @@
-import os, re, time, json, logging, hashlib, smtplib
+import os, re, time, json, shutil, asyncio, logging, hashlib, smtplib
+import orm, transfer
 from email.header import Header
 from email.mime.text import MIMEText
 from email.utils import parseaddr, formataddr
 from markdown2 import markdown
-from webframe import get, post, user2cookie, Page, filelist
+from webframe import get, post, user2cookie, gather_page, Page, SeekPage, filelist
 from config import configs
 from aiohttp import web
-from model import User, Comment, Blog, Category, next_id
+from model import User, Comment, Blog, Category, next_id, blog_views
+from search import blog_index, index_blog, rebuild_blog_index
 from apis import APIError, APIValueError, APIResourceNotFoundError, APIPermissionError
 
 logging.basicConfig(level=logging.INFO)
 
 
 @get('/')
-async def index(request, *, page=1):
+async def index(request, *, page=1, after=None, before=None):
     user = request.__user__
-    cats = await Category.findall(orderBy='created_at desc')
     page_index = Page.page2int(page)
+    # 行数一般由内存里的计数器直接给出，分类和博客列表再同时查询
     num = await Blog.findNumber('*') - 1
-    p = Page(num, page_index, item_page=configs.blog_item_page, page_show=configs.page_show)
+    p = SeekPage(num, page_index, page_size=configs.blog_item_page, page_show=configs.page_show, offset_pages=configs.offset_pages, after=after, before=before)
     p.pagelist()
-    if num == 0:
-        blogs = []
-    else:
-        blogs = await Blog.findall(where='title<>?', args=['__about__'], orderBy='created_at desc', limit=(p.offset, p.limit))
-        for blog in blogs:
-            blog.html_summary = markdown(blog.summary, extras=['code-friendly', 'fenced-code-blocks'])
+    needs = dict(cats=Category.findall(orderBy='created_at desc', compact=True))
+    if num != 0:
+        needs['blogs'] = Blog.findall(where='title<>?', args=['__about__'], orderBy='created_at desc, id desc', compact=True, **p.query())
+    data = await gather_page(**needs)
+    cats, blogs = data['cats'], data.get('blogs', [])
+    p.set_items(blogs)
+    for blog in blogs:
+        blog.html_summary = markdown(blog.summary, extras=['code-friendly', 'fenced-code-blocks'])
     return {
         '__template__' : 'index.html',
         'web_meta' : configs.web_meta,
@@ -39,8 +43,10 @@ async def index(request, *, page=1):
 @get('/about')
 async def about(request):
     user = request.__user__
-    cats = await Category.findall(orderBy='created_at desc')
-    blog = await Blog.findall(where='title=?', args=['__about__'])
+    data = await gather_page(
+        cats=Category.findall(orderBy='created_at desc', compact=True),
+        blog=Blog.findall(where='title=?', args=['__about__'], undefer=True))
+    cats, blog = data['cats'], data['blog']
     logging.info('blog:%s' % blog)
     blog[0].html_content = markdown(blog[0].content, extras=['code-friendly', 'fenced-code-blocks'])
     return {
@@ -53,7 +59,7 @@ async def about(request):
 
 @get('/signup')
 async def signin():
-    cats = await Category.findall(orderBy='created_at desc')
+    cats = await Category.findall(orderBy='created_at desc', compact=True)
     return {
         '__template__' : 'signup.html',
         'web_meta' : configs.web_meta,
@@ -62,7 +68,7 @@ async def signin():
 
 @get('/login')
 async def login():
-    cats = await Category.findall(orderBy='created_at desc')
+    cats = await Category.findall(orderBy='created_at desc', compact=True)
     return {
         '__template__' : 'login.html',
         'web_meta' : configs.web_meta,
@@ -80,14 +86,19 @@ async def logout(request):
 @get('/blog/{id}')
 async def get_blog(id, request):
     user = request.__user__
-    cats = await Category.findall(orderBy='created_at desc')
-    blog = await Blog.find(id)
-    blog.view_count = blog.view_count + 1
-    await blog.update()
-    comments = await Comment.findall(where='blog_id=?', args=[id], orderBy='created_at desc')
+    data = await gather_page(
+        cats=Category.findall(orderBy='created_at desc', compact=True),
+        blog=Blog.find(id),
+        comments=Comment.findall(where='blog_id=?', args=[id], orderBy='created_at desc', compact=True))
+    cats, blog, comments = data['cats'], data['blog'], data['comments']
+    if blog is None:
+        raise APIResourceNotFoundError('Blog')
+    # 浏览次数写回有延迟，页面上显示数据库里的值加上还没写回的部分
+    blog_views.add(id)
+    blog.view_count = (blog.view_count or 0) + blog_views.get(id)
     for c in comments:
         c.html_content = markdown(c.content, extras=['code-friendly', 'fenced-code-blocks'])
-    blog.html_content = markdown(blog.contemt, extras=['code-friendly', 'fenced-code-blocks'])
+    blog.html_content = markdown(blog.content, extras=['code-friendly', 'fenced-code-blocks'])
     return {
         '__template__' : 'blog.html',
         'web_meta' : configs.web_meta,
@@ -98,11 +109,46 @@ async def get_blog(id, request):
         'disqus' : configs.use_disqus,
     }
 
+# 按相关度取一页搜索结果，超出时间预算时只在已经扫描过的博客里排序
+async def search_blogs(q, page_index, page_size):
+    r = blog_index.search(q, offset=page_size * (page_index - 1), limit=page_size, budget=configs.search.budget)
+    p = Page(r['total'], page_index, page_size=page_size, page_show=configs.page_show)
+    p.pagelist()
+    ids = [doc_id for doc_id, score in r['hits']]
+    if not ids:
+        return p, [], r
+    rs = await Blog.findall(where='id in (%s)' % ', '.join(['?'] * len(ids)), args=ids, compact=True)
+    found = dict((blog.id, blog) for blog in rs)
+    # 索引和数据库之间短暂不一致时跳过已经删除的博客
+    blogs = [found[id] for id in ids if id in found]
+    return p, blogs, r
+
+@get('/search')
+async def search(request, *, q='', page='1'):
+    user = request.__user__
+    data = await gather_page(
+        cats=Category.findall(orderBy='created_at desc', compact=True),
+        result=search_blogs(q.strip(), Page.page2int(page), configs.blog_item_page))
+    cats, (p, blogs, r) = data['cats'], data['result']
+    for blog in blogs:
+        blog.html_summary = markdown(blog.summary, extras=['code-friendly', 'fenced-code-blocks'])
+    return {
+        '__template__' : 'search.html',
+        'web_meta' : configs.web_meta,
+        'user' : user,
+        'cats' : cats,
+        'q' : q.strip(),
+        'page' : p,
+        'blogs' : blogs,
+        'took' : r['took'],
+        'partial' : r['partial'],
+    }
+
 @get('/user/{id}')
 async def get_user(id, request):
     user = request.__user__
-    cats = await Category.findall(orderBy='created_at desc')
-    user_show = await User.find(id)
+    data = await gather_page(cats=Category.findall(orderBy='created_at desc', compact=True), user_show=User.load(id))
+    cats, user_show = data['cats'], data['user_show']
     user_show.password = '******'
     return {
         '__template__' : 'user.html',
@@ -113,20 +159,20 @@ async def get_user(id, request):
     }
 
 @get('/category/{id}')
-async def get_category(id, request, *, page='1'):
+async def get_category(id, request, *, page='1', after=None, before=None):
     user = request.__user__
-    cats = await Category.findall(orderBy='created_at desc')
-    category = await Category.find(id)
     page_index = Page.page2int(page)
     num = await Blog.findNumber('*', 'cat_id=?', [id])
-    p = Page(num, page_index, item_page=configs.blog_item_page, page_show=configs.page_show)
+    p = SeekPage(num, page_index, page_size=configs.blog_item_page, page_show=configs.page_show, offset_pages=configs.offset_pages, after=after, before=before)
     p.pagelist()
-    if num == 0:
-        blogs = []
-    else:
-        blogs = await Blog.findall(where='cat_id=?', args=[id], orderBy='created_at desc', limit=(p.offset, p.limit))
-        for blog in blogs:
-            blog.html_summary = markdown(blog.summary, extras=['code-friendly', 'fenced-code-blocks'])
+    needs = dict(cats=Category.findall(orderBy='created_at desc', compact=True), category=Category.load(id))
+    if num != 0:
+        needs['blogs'] = Blog.findall(where='cat_id=?', args=[id], orderBy='created_at desc, id desc', compact=True, **p.query())
+    data = await gather_page(**needs)
+    cats, category, blogs = data['cats'], data['category'], data.get('blogs', [])
+    p.set_items(blogs)
+    for blog in blogs:
+        blog.html_summary = markdown(blog.summary, extras=['code-friendly', 'fenced-code-blocks'])
     return {
         '__template__' : 'category.html',
         'web_meta' : configs.web_meta,
@@ -144,48 +190,74 @@ async def api_blog(*, id):
     return blog
 
 @get('/api/manage/blog')
-async def api_manage_blog(*, page='1'):
+async def api_manage_blog(*, page='1', after=None, before=None):
     page_index = Page.page2int(page)
     num = await Blog.findNumber('*')
-    p = Page(num, page_index, item_page=configs.manage_item_page, page_show=configs.page_show)
+    p = SeekPage(num, page_index, page_size=configs.manage_item_page, page_show=configs.page_show, offset_pages=configs.offset_pages, after=after, before=before)
     if num == 0:
         return dict(page=p, blogs=())
     col = ['id', 'user_id', 'user_name', 'title', 'created_at']
-    blogs = await Blog.findall(col=col, orderBy='created_at desc', limit=(p.offset, p.limit))
+    blogs = await Blog.findall(col=col, orderBy='created_at desc, id desc', compact=True, **p.query())
+    p.set_items(blogs)
     return dict(page=p, blogs=blogs)
 
 @get('/api/manage/comment')
-async def api_manage_comment(*, page='1'):
+async def api_manage_comment(*, page='1', after=None, before=None):
     page_index = Page.page2int(page)
     num = await Comment.findNumber('*')
-    p = Page(num, page_index, item_page=configs.manage_item_page, page_show=configs.page_show)
+    p = SeekPage(num, page_index, page_size=configs.manage_item_page, page_show=configs.page_show, offset_pages=configs.offset_pages, after=after, before=before)
     if num == 0:
         return dict(page=p, comments=())
-    comments = await Comment.findall(orderBy='created_at desc', limit=(p.offset, p.limit))
+    comments = await Comment.findall(orderBy='created_at desc, id desc', compact=True, **p.query())
+    p.set_items(comments)
     return dict(page=p, comments=comments)
 
 @get('/api/manage/user')
-async def api_manage_user(*, page='1'):
+async def api_manage_user(*, page='1', after=None, before=None):
     page_index = Page.page2int(page)
     num = await User.findNumber('*')
-    p = Page(num, page_index, item_page=configs.manage_item_page, page_show=configs.page_show)
+    p = SeekPage(num, page_index, page_size=configs.manage_item_page, page_show=configs.page_show, offset_pages=configs.offset_pages, after=after, before=before)
     if num ==0:
         return dict(page=p, user=())
-    users = await User.findall(orderBy='created_at desc', limit=(p.offset, p.limit))
+    users = await User.findall(orderBy='created_at desc, id desc', compact=True, **p.query())
+    p.set_items(users)
     for u in users:
         u.password = '******'
     return dict(page=p, users=users)
 
 @get('/api/manage/category')
-async def api_manage_category(*, page='1'):
+async def api_manage_category(*, page='1', after=None, before=None):
     page_index = Page.page2int(page)
     num = await Category.findNumber('*')
-    p = Page(num, page_index, item_page=configs.manage_item_page, page_show=configs.page_show)
+    p = SeekPage(num, page_index, page_size=configs.manage_item_page, page_show=configs.page_show, offset_pages=configs.offset_pages, after=after, before=before)
     if num == 0:
         return dict(page=p, category=())
-    categoyies = await Category.findall(orderBy='created_at desc', limit=(p.offset, p.limit))
+    categoyies = await Category.findall(orderBy='created_at desc, id desc', compact=True, **p.query())
+    p.set_items(categoyies)
     return dict(page=p, categoyies=categoyies)
 
+# 本进程的数据库运行统计：连接池、查询合并、结果缓存、查询计划缓存、行数计数器和语句耗时
+@get('/api/manage/stats')
+async def api_manage_stats(request, *, top='20'):
+    if request.__user__ is None or not request.__user__.admin:
+        raise APIPermissionError('Only admin can do this!')
+    models = (User, Blog, Comment, Category)
+    return dict(
+        pid=os.getpid(),
+        pools=orm.pool_stats(),
+        coalesce=orm.coalesce_stats(),
+        cache=orm.cache_stats(),
+        plans=dict((m.__table__, m.plan_stats()) for m in models),
+        counters=dict((m.__table__, m.__counter__.stats()) for m in models),
+        views=blog_views.stats(),
+        search=dict(documents=len(blog_index)),
+        queries=orm.query_stats(Page.page2int(top)))
+
+@get('/api/search')
+async def api_search(*, q='', page='1'):
+    p, blogs, r = await search_blogs(q.strip(), Page.page2int(page), configs.blog_item_page)
+    return dict(page=p, blogs=blogs, took=r['took'], partial=r['partial'])
+
 @get('/api/category/{id}')
 async def api_category(*, id):
     cat = await Category.find(id)
@@ -194,8 +266,8 @@ async def api_category(*, id):
 @get('/manage')
 async def manage_ajax(request, *, page='1'):
     user = request.__user__
-    cats = await Category.findall(orderBy='created_at desc')
-    p = Page(1, 1, item_page=configs.manage_item_page, page_show=configs.page_show)
+    cats = await Category.findall(orderBy='created_at desc', compact=True)
+    p = Page(1, 1, page_size=configs.manage_item_page, page_show=configs.page_show)
     return {
         '__template__' : 'manage.html',
         'web_meta' : configs.web_meta,
@@ -207,7 +279,7 @@ async def manage_ajax(request, *, page='1'):
 @get('/manage/blog/create')
 async def manage_blog_create(request):
     user = request.__user__
-    cats = await Category.findall(orderBy='created_at desc')
+    cats = await Category.findall(orderBy='created_at desc', compact=True)
     return {
         '__template__' : 'manage_blog_edit.html',
         'web_meta' : configs.web_meta,
@@ -220,7 +292,7 @@ async def manage_blog_create(request):
 @get('/manage/blog/edit')
 async def manage_blog_edit(requset, *, id):
     user = requset.__user__
-    cats = await Category.findall(orderBy='created_at desc')
+    cats = await Category.findall(orderBy='created_at desc', compact=True)
     path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static/upload')
     uploadlist = filelist(path)
     return {
@@ -236,7 +308,7 @@ async def manage_blog_edit(requset, *, id):
 @get('/manage/category/create')
 async def manage_category_create(requset):
     user = requset.__user__
-    cats = await Category.findall(orderBy='created_at desc')
+    cats = await Category.findall(orderBy='created_at desc', compact=True)
     return {
         '__template__' : 'manage_category_edit.html',
         'web_meta' : configs.web_meta,
@@ -249,7 +321,7 @@ async def manage_category_create(requset):
 @get('/manage/category/edit')
 async def manage_category_edit(requset, *, id):
     user = requset.__user__
-    cats = await Category.findall(orderBy='created_at desc')
+    cats = await Category.findall(orderBy='created_at desc', compact=True)
     return {
         '__template__' : 'manage_category_edit.html',
         'web_ : use'
@@ -371,12 +443,13 @@ async def api_create_blog(request, *, title, summary, content, cat_name):
     if not cat_name.strip():
         cat_id = None
     else:
-        cats = await Category.findall(where='name=?', args=[cat_name.strip()])
-        if (len(cats) == 0):
+        cat = await Category.load(cat_name.strip(), 'name')
+        if cat is None:
             raise APIValueError('cat_name', 'cat_name is not belong to Category.')
-        cat_id = cats[0].id
+        cat_id = cat.id
     blog = Blog(user_id=request.__user__.id, user_name=request.__user__.name, user_image=request.__user__.image, title=title.strip(), summary=summary.strip(), content=content.strip(), cat_id=cat_id, cat_name=cat_name.strip())
     await blog.save()
+    index_blog(blog)
     return blog
 
 @post('/api/blog/{id}')
@@ -400,11 +473,12 @@ async def api_update_blog(id, requset, *, title, summary, content, cat_name):
         blog.cat_id = None
     else:
         blog.cat_name = cat_name.strip()
-        cats = await Category.findall(where='name=?', args=[cat_name.strip()])
-        if (len(cats) == 0):
+        cat = await Category.load(cat_name.strip(), 'name')
+        if cat is None:
             raise APIValueError('cat_name' ,'cat_name is not belong to Category.')
-        blog.cat_id = cats[0].id
+        blog.cat_id = cat.id
     await blog.update()
+    index_blog(blog)
     return blog
 
 @post('/api/blog/{id}/delete')
@@ -414,7 +488,11 @@ async def api_delete_blog(request, *, id):
     blog = await Blog.find(id)
     if blog is None:
         raise APIResourceNotFoundError('Blog')
-    await blog.remove()
+    # 博客和它的评论在同一个事务里删除
+    async with orm.transaction():
+        await Comment.removeall('blog_id=?', [id])
+        await blog.remove()
+    blog_index.remove(id)
     return dict(id=id)
 
 @post('api/blog/{id}/comment')
@@ -467,6 +545,50 @@ async def upload(request, *, file):
         f.write(file.file.read())
     return dict(filename=os.path.basename(filename))
 
+# 流式下载全部数据（或models指定的表，逗号分隔），format为gz或zst
+@get('/api/export')
+async def api_export(request, *, models='', format='gz'):
+    if request.__user__ is None or not request.__user__.admin:
+        raise APIPermissionError('Only admin can do this!')
+    if format not in ('gz', 'zst'):
+        raise APIValueError('format', 'format must be gz or zst.')
+    try:
+        selected = transfer.select_models([m for m in models.split(',') if m])
+        stream = transfer.export_stream(selected, format, configs.transfer.batch)
+    except ValueError as e:
+        raise APIValueError('models', str(e))
+    resp = web.StreamResponse()
+    resp.content_type = 'application/octet-stream'
+    resp.headers['Content-Disposition'] = 'attachment; filename="%s-%s.jsonl.%s"' % (configs.database.db, time.strftime('%Y%m%d%H%M%S'), format)
+    await resp.prepare(request)
+    # 导出耗时与数据量成正比，不受请求的总时间限制，每条语句仍受statement_timeout限制
+    with orm.no_deadline():
+        async for data in stream:
+            resp.write(data)
+            await resp.drain()
+    await resp.write_eof()
+    return resp
+
+# 上传导出文件并导入；导入中断后用name（上次返回的文件名）重新提交，从断点继续
+@post('/api/import')
+async def api_import(request, *, file=None, name=None):
+    if request.__user__ is None or not request.__user__.admin:
+        raise APIPermissionError('Only admin can do this!')
+    os.makedirs(configs.transfer.dir, exist_ok=True)
+    if file is not None:
+        name = os.path.basename(file.filename)
+        with open(os.path.join(configs.transfer.dir, name), 'wb') as f:
+            # 按块复制上传的文件，不把整个文件读进内存
+            await asyncio.get_event_loop().run_in_executor(None, shutil.copyfileobj, file.file, f)
+    if not name or not os.path.exists(os.path.join(configs.transfer.dir, os.path.basename(name))):
+        raise APIValueError('name', 'Import file not found.')
+    path = os.path.join(configs.transfer.dir, os.path.basename(name))
+    with orm.no_deadline():
+        r = await transfer.import_file(path, configs.transfer.batch)
+        if Blog in r['tables']:
+            await rebuild_blog_index(blog_index)
+    return dict(name=os.path.basename(path), rows=r['rows'], resumed=r['resumed'], tables=[m.__table__ for m in r['tables']])
+
 @post('/api/create_category')
 async def api_create_category(request, *, name):
     if request.__user__ is None or not request.__user__.admin:
@@ -0,0 +1,76 @@
+'''
+Primary key generators for the models.
+
+Snowflake ids are 64-bit integers: 41 bits of milliseconds since EPOCH, 10 bits of worker id and
+12 bits of sequence, so ids grow with time and every process (worker) generates its own range.
+They are stored as 20-digit zero padded strings, which sort like the integers and fit the existing
+varchar primary keys next to the old uuid based ids, so old and new ids keep working side by side.
+'''
+import os, time, uuid, threading
+
+__author__ = 'cjh'
+
+# 2016-01-01 00:00:00 UTC，41位毫秒数可以用到2085年
+EPOCH = 1451606400000
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+
+class SnowflakeIds(object):
+    def __init__(self, worker_id=0):
+        if not 0 <= worker_id <= MAX_WORKER:
+            raise ValueError('worker_id must be between 0 and %s' % MAX_WORKER)
+        self.worker_id = worker_id
+        self.last = -1
+        self.sequence = 0
+        self._lock = threading.Lock()
+
+    def next_int(self):
+        with self._lock:
+            now = int(time.time() * 1000) - EPOCH
+            # 时钟回拨时继续使用上一次的时间戳，保证单调递增
+            if now <= self.last:
+                now = self.last
+                self.sequence = (self.sequence + 1) & MAX_SEQUENCE
+                # 同一毫秒内的序号用完了，借用下一毫秒
+                if self.sequence == 0:
+                    now = self.last + 1
+            else:
+                self.sequence = 0
+            self.last = now
+            return (now << (WORKER_BITS + SEQUENCE_BITS)) | (self.worker_id << SEQUENCE_BITS) | self.sequence
+
+    def __call__(self):
+        return '%020d' % self.next_int()
+
+
+# 原来的id：15位毫秒时间戳 + 32位uuid4 + '000'，共50个字符
+class UuidIds(object):
+    def __call__(self):
+        return '%015d%s000' % (int(time.time()*1000), uuid.uuid4().hex)
+
+
+def id_time(id):
+    '''creation time (seconds) encoded in an id of either format.'''
+    if len(id) == 20:
+        return ((int(id) >> (WORKER_BITS + SEQUENCE_BITS)) + EPOCH) / 1000.0
+    return int(id[:15]) / 1000.0
+
+
+__generator = SnowflakeIds(os.getpid() & MAX_WORKER)
+
+def configure(generator='snowflake', worker_id=None):
+    '''choose the id generator; worker_id defaults to the process id, set it explicitly when running several processes.'''
+    global __generator
+    if generator == 'uuid':
+        __generator = UuidIds()
+    elif generator == 'snowflake':
+        __generator = SnowflakeIds(os.getpid() & MAX_WORKER if worker_id is None else worker_id)
+    else:
+        raise ValueError('unknown id generator: %s' % generator)
+    return __generator
+
+def next_id():
+    return __generator()
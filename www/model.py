@@ -1,41 +1,59 @@
 '''Model for user, blog, comment'''
 import time
-import uuid
-from orm import Model, StringField, BoolField, FloatField, TextField, IntegerField
+import idgen
+from orm import Model, StringField, BoolField, FloatField, TextField, IntegerField, WriteBehindCounter
 
 __author__ = 'cjh'
 
-# 生成唯一标识符
+# 生成唯一标识符，默认是按时间递增的64位snowflake id，生成器由idgen.configure选择
 def next_id():
-    return '%015d%s000' % (int(time.time()*1000), uuid.uuid4().hex)
+    return idgen.next_id()
 
 class User(Model):
     __table__ = 'user'
+    __indexes__ = (('created_at', 'id'),)
+    # 登录、注册按email查找
+    __unique__ = ('email',)
 
     # 后面的id,email等会被实例的id,email覆盖
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     email = StringField(ddl='varchar(50)')
     passwd = StringField(ddl='varchar(50)')
-    admin = StringField(ddl='varchar(50)')
-    name = BoolField()
+    admin = BoolField()
+    name = StringField(ddl='varchar(50)')
     image = StringField(ddl='varchar(50)')
     created_at = FloatField(default=time.time)
 
 
 class Blog(Model):
     __table__ = 'blogs'
+    __cache__ = True
+    # 分类页需要每个分类下的博客数
+    __counters__ = ('cat_id',)
+    # 关于页面按标题查找
+    __indexes__ = (('created_at', 'id'), ('cat_id', 'created_at'), 'title')
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     user_id = StringField(ddl='varchar(50)')
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
-    name = StringField(ddl='varchar(50)')
+    title = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
     content = TextField()
+    cat_id = StringField(ddl='varchar(50)')
+    cat_name = StringField(ddl='varchar(50)')
+    view_count = IntegerField()
     created_at = FloatField(default=time.time)
 
+# 博客浏览次数先在内存里累加，定时批量写回，由app启动和关闭
+blog_views = WriteBehindCounter(Blog, 'view_count')
+
 class Comment(Model):
     __table__ = 'comments'
+    # 博客页按blog_id取评论并按时间排序
+    __indexes__ = (('created_at', 'id'), ('blog_id', 'created_at'))
+    # 评论列表总是要显示评论内容，不延迟加载
+    __deferred__ = ()
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     blog_id = StringField(ddl='varchar(50)')
@@ -47,6 +65,9 @@ class Comment(Model):
 
 class Category(Model):
     __table__ = 'category'
-    id = StringField(primary_key=True, default=next_id, ddl='varchaer(50)')
-    name = StringField(ddl='varcahr(50)')
+    __cache__ = True
+    # 发表博客时按分类名查找分类
+    __indexes__ = (('created_at', 'id'), 'name')
+    id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
+    name = StringField(ddl='varchar(50)')
     created_at = FloatField(default=time.time)
\ No newline at end of file
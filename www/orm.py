@@ -1,83 +1,1014 @@
 import asyncio
-import aiomysql
 import logging
+import re
+import sys
+import time
+import random
+import bisect
+import contextlib
+import contextvars
+from collections import OrderedDict, deque
+import orm_sqlite
+#只用SQLite时不需要安装aiomysql
+try:
+    import aiomysql
+except ImportError:
+    aiomysql = None
 logging.basicConfig(level=logging.INFO, format='[%(asctime)s]%(name)s:%(levelname)s:%(message)s')
 
 __author__ = 'cjh'
 
-def log(sql, args=()):
-    logging.info('SQL: %s'%sql)
+#语句耗时统计：以带占位符的SQL为语句形状，按固定的对数刻度分桶记录耗时分布
+class QueryStats(object):
+    BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5)
+
+    def __init__(self, max_shapes=512):
+        self.max_shapes = max_shapes
+        self.shapes = dict()
+
+    def record(self, sql, elapsed):
+        entry = self.shapes.get(sql)
+        if entry is None:
+            #形状太多时（例如拼接了字面量的SQL）归到同一类，避免无限增长
+            if len(self.shapes) >= self.max_shapes:
+                sql = '<other>'
+                entry = self.shapes.get(sql)
+            if entry is None:
+                entry = self.shapes[sql] = dict(count=0, total=0.0, max=0.0, buckets=[0] * (len(self.BUCKETS) + 1))
+        entry['count'] += 1
+        entry['total'] += elapsed
+        entry['max'] = max(entry['max'], elapsed)
+        entry['buckets'][bisect.bisect_left(self.BUCKETS, elapsed)] += 1
+
+    #由分桶估算百分位数，返回所在桶的上界
+    def _percentile(self, entry, p):
+        rank = entry['count'] * p / 100.0
+        seen = 0
+        for i, n in enumerate(entry['buckets']):
+            seen += n
+            if n and seen >= rank:
+                return self.BUCKETS[i] if i < len(self.BUCKETS) else entry['max']
+        return entry['max']
+
+    def stats(self, top=20):
+        rs = []
+        for sql, entry in sorted(self.shapes.items(), key=lambda kv: kv[1]['total'], reverse=True)[:top]:
+            rs.append(dict(sql=sql, count=entry['count'], total=entry['total'], avg=entry['total'] / entry['count'], max=entry['max'],
+                           p50=self._percentile(entry, 50), p99=self._percentile(entry, 99), buckets=list(entry['buckets'])))
+        return rs
+
+
+__query_stats = QueryStats()
+#threshold秒以上的语句写入慢查询日志（logger名为orm.slow），其余语句按sample_rate抽样写INFO日志
+#explain为True时对慢的SELECT在后台执行EXPLAIN，同一形状每explain_interval秒最多一次
+__query_log = dict(threshold=0.2, sample_rate=0.01, explain=False, explain_interval=60)
+__explained = dict()
+_slow_logger = logging.getLogger('orm.slow')
+
+def configure_query_log(threshold=0.2, sample_rate=0.01, explain=False, explain_interval=60, file=None):
+    '''set the slow-query threshold (seconds), the sampling rate of routine statements and EXPLAIN capture.'''
+    __query_log.update(threshold=threshold, sample_rate=sample_rate, explain=explain, explain_interval=explain_interval)
+    if file:
+        handler = logging.FileHandler(file, encoding='utf-8')
+        handler.setFormatter(logging.Formatter('[%(asctime)s]%(levelname)s:%(message)s'))
+        _slow_logger.addHandler(handler)
+
+def query_stats(top=20):
+    '''latency histograms of the top statement shapes by total time.'''
+    return __query_stats.stats(top)
+
+#记录一条语句的耗时，慢语句写慢查询日志，其余抽样记录
+def log(sql, args=(), elapsed=0.0, rows=None):
+    __query_stats.record(sql, elapsed)
+    if elapsed >= __query_log['threshold']:
+        #参数里可能有整篇博客内容，只记录前200个字符
+        _slow_logger.warning('slow query %.1fms rows=%s SQL: %s args: %s'%(elapsed * 1000, rows, sql, str(args)[:200]))
+        if __query_log['explain'] and sql.lstrip()[:6].lower() == 'select':
+            now = time.time()
+            if now - __explained.get(sql, 0) >= __query_log['explain_interval']:
+                __explained[sql] = now
+                #EXPLAIN在后台单独借连接执行，不增加当前请求的延迟，也不占用当前事务的连接
+                asyncio.ensure_future(_explain(sql, args)).add_done_callback(_explain_done)
+    elif random.random() < __query_log['sample_rate']:
+        logging.info('SQL %.1fms rows=%s: %s'%(elapsed * 1000, rows, sql))
+
+async def _explain(sql, args):
+    async with _read_pool().get() as conn:
+        async with conn.cursor(__driver.DictCursor) as cur:
+            await cur.execute(('explain query plan ' if __backend == 'sqlite' else 'explain ') + sql, args or ())
+            rs = await cur.fetchall()
+    for r in rs:
+        _slow_logger.warning('explain %s: %s'%(sql, r))
+
+def _explain_done(task):
+    if not task.cancelled() and task.exception() is not None:
+        _slow_logger.warning('explain failed: %s'%task.exception())
+
+#求样本的百分位数，样本为空时返回0
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+#包装aiomysql连接池：限制同时借出的连接数，并记录借出等待时间、占用时间、使用中/空闲连接数
+#limit可以在运行时调整（见_autosize），底层aiomysql池的maxsize是limit的上限
+class PoolMonitor(object):
+    def __init__(self, pool, name, limit, samples=1024):
+        self.pool = pool
+        self.name = name
+        self.limit = limit
+        self.in_use = 0
+        self.peak = 0
+        self.checkouts = 0
+        #因为池满而不得不等待的借出次数
+        self.waited = 0
+        self.wait_times = deque(maxlen=samples)
+        self.hold_times = deque(maxlen=samples)
+        #自上次调整以来的等待时间，只有开启了_autosize时才记录（由它创建并在每个周期换新）
+        self.window = None
+        self._held = dict()
+        self._cond = asyncio.Condition()
+
+    async def acquire(self):
+        start = time.time()
+        async with self._cond:
+            if self.in_use >= self.limit:
+                self.waited += 1
+            while self.in_use >= self.limit:
+                await self._cond.wait()
+            self.in_use += 1
+            self.peak = max(self.peak, self.in_use)
+        try:
+            conn = await self.pool.acquire()
+        except BaseException:
+            await self._release_slot()
+            raise
+        now = time.time()
+        self.checkouts += 1
+        self.wait_times.append(now - start)
+        if self.window is not None:
+            self.window.append(now - start)
+        self._held[id(conn)] = now
+        return conn
+
+    async def release(self, conn):
+        start = self._held.pop(id(conn), None)
+        if start is not None:
+            self.hold_times.append(time.time() - start)
+        await self.pool.release(conn)
+        await self._release_slot()
+
+    async def _release_slot(self):
+        async with self._cond:
+            self.in_use -= 1
+            self._cond.notify()
+
+    async def resize(self, limit):
+        '''change the number of connections that may be checked out at once.'''
+        async with self._cond:
+            logging.info('resize pool %s: %s => %s'%(self.name, self.limit, limit))
+            self.limit = limit
+            self._cond.notify_all()
+        #缩小时只关掉超出上限的那几个空闲连接，其余空闲连接留着继续用
+        while self.pool.size > limit and self.pool.freesize > 0:
+            conn = await self.pool.acquire()
+            conn.close()
+            await self.pool.release(conn)
+
+    @contextlib.asynccontextmanager
+    async def get(self):
+        conn = await self.acquire()
+        try:
+            yield conn
+        finally:
+            await self.release(conn)
+
+    def close(self):
+        self.pool.close()
+
+    async def wait_closed(self):
+        await self.pool.wait_closed()
+
+    def stats(self):
+        return dict(
+            name=self.name,
+            limit=self.limit,
+            size=self.pool.size,
+            in_use=self.in_use,
+            idle=self.pool.freesize,
+            checkouts=self.checkouts,
+            waited=self.waited,
+            wait_p50=percentile(self.wait_times, 50),
+            wait_p99=percentile(self.wait_times, 99),
+            hold_p50=percentile(self.hold_times, 50),
+            hold_p99=percentile(self.hold_times, 99),
+        )
+
+
+#按等待时间的百分位数自动调整连接池大小：
+#窗口内p95等待超过high_wait就放大，几乎不等待且峰值占用不到一半就缩小，始终在[lower, upper]之间
+async def _autosize(monitor, lower, upper, interval=10, high_wait=0.01, low_wait=0.001, samples=4096):
+    monitor.window = deque(maxlen=samples)
+    while True:
+        await asyncio.sleep(interval)
+        window, monitor.window = monitor.window, deque(maxlen=samples)
+        peak, monitor.peak = monitor.peak, monitor.in_use
+        p95 = percentile(window, 95)
+        limit = monitor.limit
+        if p95 > high_wait and limit < upper:
+            limit = min(upper, limit + max(1, limit // 4))
+        elif p95 <= low_wait and peak < limit // 2 and limit > lower:
+            limit = max(lower, limit - 1)
+        if limit != monitor.limit:
+            await monitor.resize(limit)
+
+
+#创建单个连接池，主库和每个只读副本各用一个
+#配置了autosize时底层池按上限创建，实际可借出的连接数由PoolMonitor.limit控制
+async def _create_pool(loop, name, **kwargs):
+    maxsize = kwargs.get('maxsize', 10)
+    autosize = kwargs.get('autosize', None)
+    if __backend == 'sqlite':
+        #db是数据库文件路径
+        pool = await orm_sqlite.create_pool(
+            db = kwargs['db'],
+            maxsize=max(maxsize, autosize['upper']) if autosize else maxsize,
+            minsize=kwargs.get('minsize', 1),
+            loop=loop
+        )
+    else:
+        pool = await aiomysql.create_pool(
+            #关键参数
+            host = kwargs.get('host', 'localhost'),
+            port = kwargs.get('port', '3306'),
+            user = kwargs['user'],
+            password = kwargs['password'],
+            db = kwargs['db'],
+            charset = kwargs.get('charset', 'utf-8'),
+            autocommit = kwargs.get('autocommit', True),
+            maxsize=max(maxsize, autosize['upper']) if autosize else maxsize,
+            minsize=kwargs.get('minsize', 1),
+
+            #接受一个event_loop实例
+            loop=loop
+        )
+    monitor = PoolMonitor(pool, name, maxsize)
+    if autosize:
+        __autosizers.append(asyncio.ensure_future(_autosize(monitor, **autosize)))
+    return monitor
 
 #创建连接池，每个HTTP请求都从池中获得数据库连接
+#database配置里的replicas是只读副本列表，每项只需写出与主库不同的配置（通常是host/port）
+#读写分离后，rw_window秒内写过主库的会话（请求）继续从主库读，避免读到副本上的旧数据
 async def create_pool(loop, **kwargs):
     logging.info('create database connection pool...')
-    #全局__pool用于存储整个连接池
-    global __pool
-    __pool = await aiomysql.create_pool(
-        #关键参数
-        host = kwargs.get('host', 'localhost'),
-        port = kwargs.get('port', '3306'),
-        user = kwargs['user'],
-        password = kwargs['password'],
-        db = kwargs['db'],
-        charset = kwargs.get('charset', 'utf-8'),
-        autocommit = kwargs.get('autocommit', True),
-        maxsize=kwargs.get('maxsize', 10),
-        minsize=kwargs.get('minsize', 1),
-
-        #接受一个event_loop实例
-        loop=loop
-    )
+    #全局__pool用于存储主库连接池，__replicas存储只读副本连接池
+    global __pool, __replicas, __rw_window, __coalesce, __statement_timeout
+    use_backend(kwargs.pop('backend', 'mysql'))
+    __coalesce = kwargs.pop('coalesce', True)
+    __statement_timeout = kwargs.pop('statement_timeout', None)
+    #request_timeout由中间件使用
+    kwargs.pop('request_timeout', None)
+    replicas = kwargs.pop('replicas', None) or []
+    __rw_window = kwargs.pop('rw_window', 0)
+    result_cache = kwargs.pop('result_cache', None)
+    if result_cache:
+        enable_result_cache(**result_cache)
+    slow_log = kwargs.pop('slow_log', None)
+    if slow_log:
+        configure_query_log(**slow_log)
+    __pool = await _create_pool(loop, 'primary', **kwargs)
+    __replicas = []
+    for replica in replicas:
+        config = dict(kwargs)
+        config.update(replica)
+        logging.info('create replica connection pool for %s:%s...'%(config.get('host'), config.get('port')))
+        __replicas.append(await _create_pool(loop, 'replica-%s'%len(__replicas), **config))
 
 async def close_pool():
     logging.info('close datebase connection pool...')
-    global __pool
-    __pool.close()
-    await __pool.wait_closed()
+    global __pool, __replicas
+    for task in __autosizers:
+        task.cancel()
+    del __autosizers[:]
+    for pool in [__pool] + __replicas:
+        pool.close()
+    for pool in [__pool] + __replicas:
+        await pool.wait_closed()
+
+
+def pool_stats():
+    '''checkout wait/hold times and in-use/idle counts for the primary and every replica pool.'''
+    return [pool.stats() for pool in [__pool] + __replicas]
+
+
+#backend为mysql（默认，aiomysql）或sqlite（标准库sqlite3，db为数据库文件路径）
+def use_backend(name):
+    '''select the database backend, mysql or sqlite; create_pool calls this with the backend config key.'''
+    global __backend, __driver
+    if name not in ('mysql', 'sqlite'):
+        raise ValueError('unknown database backend: %s'%name)
+    if name == 'mysql' and aiomysql is None:
+        raise ImportError('aiomysql is required for the mysql backend')
+    __backend = name
+    __driver = orm_sqlite if name == 'sqlite' else aiomysql
+
+def backend():
+    '''name of the database backend in use.'''
+    return __backend
+
+
+__backend = 'mysql'
+__driver = aiomysql
+__replicas = []
+__autosizers = []
+__rw_window = 0
+__next_replica = 0
+#写操作计数，单飞查询据此判断发起之后有没有写过
+__writes = 0
+#当前请求/会话的标识，由中间件通过bind_session设置
+__session = contextvars.ContextVar('orm_session', default=None)
+#会话标识 ==> 最近一次写主库的时间
+__last_writes = dict()
+
+def bind_session(key):
+    '''bind the current request (task) to a session key used for read-your-writes routing.'''
+    return __session.set(key)
+
+#写操作开始和结束时各记一次，写的过程中发起的查询也不会被写完之后的请求合并
+def _bump_writes():
+    global __writes
+    __writes += 1
+
+#记录当前会话写过主库
+def _mark_write():
+    _bump_writes()
+    key = __session.get()
+    if key is None or not __rw_window:
+        return
+    now = time.time()
+    __last_writes[key] = now
+    if len(__last_writes) > 10000:
+        for k, t in list(__last_writes.items()):
+            if now - t > __rw_window:
+                del __last_writes[k]
+
+#当前会话是否必须读主库：没有副本，或者刚写过主库
+def _reads_primary():
+    if not __replicas:
+        return True
+    key = __session.get()
+    return key is not None and time.time() - __last_writes.get(key, 0) < __rw_window
+
+#读操作使用的连接池：没有副本或当前会话刚写过主库时读主库，否则轮询各个副本
+def _read_pool():
+    global __next_replica
+    if _reads_primary():
+        return __pool
+    __next_replica = (__next_replica + 1) % len(__replicas)
+    return __replicas[__next_replica]
+
+
+#将SQL中的占位符'?'替换为aiomysql使用的'%s'
+def compile_sql(sql):
+    return sql.replace('?', '%s')
 
 
 #封装SQL_SELECT语句
-async def select(sql, args, size = True):
-    log(sql,args)
-    global __pool
-    async with __pool.get() as conn:
+async def select(sql, args, size=None, timeout=None):
+    return await _select(compile_sql(sql), args, size, timeout)
+
+
+#超时：每条语句最多执行statement_timeout秒（可以按调用传timeout），
+#deadline()给整个请求设定的时间预算通过contextvars传给请求里的每条语句，语句只能使用剩余的预算
+class QueryTimeout(asyncio.TimeoutError):
+    pass
+
+__statement_timeout = None
+#当前请求的截止时间（time.monotonic()）
+__deadline = contextvars.ContextVar('orm_deadline', default=None)
+
+@contextlib.contextmanager
+def deadline(seconds):
+    '''with orm.deadline(seconds): queries in the block (and tasks started from it) share a budget of seconds, 0 or None means no limit.'''
+    if not seconds:
+        yield
+        return
+    end = time.monotonic() + seconds
+    current = __deadline.get()
+    token = __deadline.set(end if current is None else min(current, end))
+    try:
+        yield
+    finally:
+        __deadline.reset(token)
+
+@contextlib.contextmanager
+def no_deadline():
+    '''lift the request deadline inside the block, for long jobs such as export/import; statement_timeout still applies.'''
+    token = __deadline.set(None)
+    try:
+        yield
+    finally:
+        __deadline.reset(token)
+
+#请求剩余的预算，没有设定时返回None，已经用完时抛出QueryTimeout
+def _budget():
+    end = __deadline.get()
+    if end is None:
+        return None
+    left = end - time.monotonic()
+    if left <= 0:
+        raise QueryTimeout('request deadline exceeded')
+    return left
+
+#一条语句可以执行的时间：语句超时和请求剩余预算中较小的一个，都没有时返回None
+def _time_limit(timeout=None):
+    if timeout is None:
+        timeout = __statement_timeout
+    left = _budget()
+    if left is not None and (not timeout or left < timeout):
+        return left
+    return timeout or None
+
+#在连接conn上执行coro（语句以及读取结果），超时或被取消时中断语句并关闭连接，
+#关闭的连接还给连接池时会被丢弃，池里不会留下状态未知的连接
+async def _bounded(conn, coro, timeout, sql):
+    limit = _time_limit(timeout)
+    task = asyncio.ensure_future(coro)
+    try:
+        done, _ = await asyncio.wait((task,), timeout=limit)
+    except asyncio.CancelledError:
+        await _abandon(conn, task)
+        raise
+    if not done:
+        await _abandon(conn, task)
+        raise QueryTimeout('query timed out after %.3fs: %s'%(limit, sql))
+    return task.result()
+
+async def _abandon(conn, task):
+    #先让数据库停止执行，再取消任务，取消时不用等语句执行完
+    if __backend == 'sqlite':
+        conn.interrupt()
+    else:
+        owner = _owner(conn)
+        if owner is not None:
+            asyncio.ensure_future(_kill_query(owner, conn.thread_id())).add_done_callback(_kill_done)
+        conn.close()
+    task.cancel()
+    try:
+        await task
+    except BaseException:
+        pass
+    conn.close()
+
+#借出conn的连接池
+def _owner(conn):
+    for pool in [__pool] + __replicas:
+        if id(conn) in pool._held:
+            return pool
+    return None
+
+#连接关闭后MySQL仍会把已经开始的语句执行完，用另一个连接KILL QUERY
+async def _kill_query(pool, thread_id):
+    async with pool.get() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute('kill query %d'%thread_id)
+
+def _kill_done(task):
+    if not task.cancelled() and task.exception() is not None:
+        logging.warning('kill query failed: %s'%task.exception())
+
+
+#当前任务处于transaction()中时使用事务的连接，否则从pool()返回的连接池借出
+#等待借出连接的时间也计入请求的预算
+@contextlib.asynccontextmanager
+async def _connection(pool):
+    tx = _current_tx.get()
+    if tx is not None:
+        yield tx.conn
+    else:
+        pool = pool()
+        left = _budget()
+        if left is None:
+            conn = await pool.acquire()
+        else:
+            try:
+                conn = await asyncio.wait_for(pool.acquire(), left)
+            except asyncio.TimeoutError:
+                raise QueryTimeout('request deadline exceeded waiting for a connection')
         try:
-            async with conn.cursor(aiomysql.DictCursor) as cur:
-            #替换占位符
-                await cur.execute(sql.replace('?','%s'),args or ())
-                if size:
-                    rs = await cur.fetchmany(size)
-                else:
-                    rs = await cur.fetchall()
-        except BaseException:
-            raise
+            yield conn
         finally:
-            conn.close()
-        logging.info('row returned: %s' %len(rs))
+            await pool.release(conn)
+
+def _primary_pool():
+    return __pool
+
+
+#单飞（single-flight）：相同SQL、相同参数的查询正在执行时，后来的请求等待同一个结果，不再占用连接
+#只合并同一次写操作之后发起的查询，发起查询之后有过写操作（见_mark_write）就不再加入，避免读到写之前的结果
+__flights = dict()
+__flight_stats = dict(flights=0, coalesced=0)
+__coalesce = True
+
+def coalesce_stats():
+    '''number of queries sent to the database and of identical concurrent queries that shared their result.'''
+    return dict(__flight_stats, in_flight=len(__flights))
+
+#执行已经替换过占位符的SELECT语句，Model的查询计划直接走这里
+#tuples为True时每行是元组（列的顺序与语句一致），由Model按语句形状解码，否则每行是dict
+async def _select(sql, args, size=None, timeout=None, tuples=False):
+    #事务里的查询使用事务自己的连接，读的可能是未提交的数据，不合并
+    if not __coalesce or _current_tx.get() is not None:
+        return await _query(sql, args, size, timeout, tuples)
+    try:
+        key = (sql, tuple(args or ()), size, _reads_primary(), tuples)
+        flight = __flights.get(key)
+    except TypeError:
+        return await _query(sql, args, size, timeout, tuples)
+    if flight is not None and flight[0] == __writes:
+        __flight_stats['coalesced'] += 1
+        #查询本身受发起者的超时限制，等待者只受自己请求的剩余预算限制
+        return await _join(flight, _budget(), sql)
+    __flight_stats['flights'] += 1
+    #查询在单独的任务里执行，发起者被取消时其他等待者不受影响
+    task = asyncio.ensure_future(_query(sql, args, size, timeout, tuples))
+    flight = __flights[key] = [__writes, task, 0]
+    task.add_done_callback(lambda t: __flights.pop(key, None) if __flights.get(key) is flight else None)
+    return await _join(flight, None, sql)
+
+#等待单飞查询的结果，flight为[写操作计数, 查询任务, 等待者数量]
+async def _join(flight, left, sql):
+    task = flight[1]
+    flight[2] += 1
+    try:
+        return await asyncio.wait_for(asyncio.shield(task), left)
+    except asyncio.TimeoutError:
+        if task.done():
+            raise
+        raise QueryTimeout('request deadline exceeded waiting for: %s'%sql)
+    finally:
+        flight[2] -= 1
+        #所有等待者都超时或被取消了，中断查询，释放连接
+        if flight[2] == 0 and not task.done():
+            task.cancel()
+
+#pool是返回连接池的函数，默认按_read_pool读副本或主库
+async def _query(sql, args, size=None, timeout=None, tuples=False, pool=_read_pool):
+    async def run(conn):
+        async with (conn.cursor() if tuples else conn.cursor(__driver.DictCursor)) as cur:
+            await cur.execute(sql, args or ())
+            if size:
+                return await cur.fetchmany(size)
+            return await cur.fetchall()
+    async with _connection(pool) as conn:
+        start = time.time()
+        rs = await _bounded(conn, run(conn), timeout, sql)
+        log(sql, args, time.time() - start, len(rs))
         return rs
 
 
+#估算一次查询结果占用的内存（结果列表、每行的dict或元组以及各个值）
+def _sizeof(rs):
+    size = sys.getsizeof(rs)
+    for r in rs:
+        size += sys.getsizeof(r)
+        for v in (r.values() if isinstance(r, dict) else r):
+            size += sys.getsizeof(v)
+    return size
+
+
+#查询结果缓存：以最终SQL和参数为key，带TTL，超过容量按LRU淘汰
+#每条结果按表打标签，对某张表的写操作会立即让这张表的所有缓存结果失效
+class ResultCache(object):
+    def __init__(self, capacity=1024, ttl=60):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+        #key ==> (过期时间, 表名, 结果, 估算大小)
+        self._entries = OrderedDict()
+        #表名 ==> 该表的缓存key集合
+        self._tags = dict()
+        #表名 ==> 写操作计数，查询期间表被写过时结果不入缓存
+        self._generations = dict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry[0] < time.time():
+            self._discard(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[2]
+
+    def generation(self, table):
+        return self._generations.get(table, 0)
+
+    def put(self, key, table, rs, generation):
+        if generation != self.generation(table):
+            return
+        self._discard(key)
+        size = _sizeof(rs)
+        self._entries[key] = (time.time() + self.ttl, table, rs, size)
+        self._tags.setdefault(table, set()).add(key)
+        self.bytes += size
+        while len(self._entries) > self.capacity:
+            self._discard(next(iter(self._entries)))
+            self.evictions += 1
+
+    def invalidate(self, table):
+        self._generations[table] = self.generation(table) + 1
+        for key in list(self._tags.pop(table, ())):
+            self._discard(key)
+
+    def discard(self, key):
+        '''drop one cached result.'''
+        self._discard(key)
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[3]
+            keys = self._tags.get(entry[1])
+            if keys is not None:
+                keys.discard(key)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return dict(entries=len(self._entries), capacity=self.capacity, ttl=self.ttl, hits=self.hits, misses=self.misses,
+                    hit_ratio=self.hits / total if total else 0.0, evictions=self.evictions, bytes=self.bytes)
+
+
+__result_cache = None
+
+def enable_result_cache(capacity=1024, ttl=60):
+    '''turn on the result cache used by models that set __cache__ = True.'''
+    global __result_cache
+    __result_cache = ResultCache(capacity, ttl)
+    return __result_cache
+
+def cache_stats():
+    '''hit ratio and estimated memory footprint of the result cache, None when it is disabled.'''
+    return __result_cache.stats() if __result_cache else None
+
+#只让按主键查出的这几行（Model.find的缓存结果）失效，这张表的其他缓存结果不受影响
+def invalidate_rows(cls, pks):
+    '''drop the cached find() results of the given primary keys of cls.'''
+    if not __result_cache or cls.__cache_table__ is None:
+        return
+    sql = cls._find_sql()
+    for pk in pks:
+        for primary in (True, False):
+            __result_cache.discard((sql, (pk,), 1, True, primary))
+
+def invalidate(table):
+    '''drop every cached result of table.'''
+    tx = _current_tx.get()
+    if tx is not None:
+        tx.tables.add(table)
+    _forget_loaders(table)
+    if __result_cache:
+        __result_cache.invalidate(table)
+
+#table为None或者没有开启缓存时直接查询数据库
+async def _cached_select(table, sql, args, size=None, timeout=None, tuples=False):
+    cache = __result_cache
+    #事务中可能读到尚未提交的数据，不走缓存
+    if cache is None or table is None or _current_tx.get() is not None:
+        return await _select(sql, args, size, timeout, tuples)
+    #key记录结果来自主库还是副本：刚写过主库的会话（rw_window内）只读主库的结果，不会拿到其他会话从副本读回的旧数据
+    primary = _reads_primary()
+    key = (sql, tuple(args or ()), size, tuples, primary)
+    rs = cache.get(key)
+    if rs is not None:
+        return rs
+    generation = cache.generation(table)
+    rs = await _select(sql, args, size, timeout, tuples)
+    #副本可能还没追上刚失效的写操作，只缓存主库的结果；没有配置副本时所有读都走主库
+    if primary:
+        cache.put(key, table, rs, generation)
+    return rs
+
+
+#用服务端（无缓冲）游标逐批读取结果，内存占用只与batch有关，与表大小无关
+#消费者中途退出（break、取消、异常）时结果集还没读完，直接关闭连接，不把脏连接放回池中
+#语句和每一批的读取分别受超时限制，消费者处理每一批的时间不计入
+async def iterate(sql, args, batch=100, timeout=None, tuples=False):
+    pool = _read_pool()
+    conn = await pool.acquire()
+    finished = False
+    try:
+        cur = await conn.cursor(__driver.SSCursor if tuples else __driver.SSDictCursor)
+        start = time.time()
+        await _bounded(conn, cur.execute(sql, args or ()), timeout, sql)
+        log(sql, args, time.time() - start)
+        while True:
+            rs = await _bounded(conn, cur.fetchmany(batch), timeout, sql)
+            if not rs:
+                break
+            yield rs
+        await cur.close()
+        finished = True
+    finally:
+        if not finished:
+            conn.close()
+        await pool.release(conn)
+
+
 #封装insert,update,delete语句
-async def execute(sql, args, autocommit=True):
-    log(sql)
-    async with __pool.get() as coon:
+async def execute(sql, args, autocommit=True, timeout=None):
+    sql = compile_sql(sql)
+    _mark_write()
+    #在transaction()中由事务统一提交
+    if _current_tx.get() is not None:
+        autocommit = True
+    async def run(conn):
+        async with conn.cursor(__driver.DictCursor) as cur:
+            await cur.execute(sql, args)
+            return cur.rowcount
+    async with _connection(_primary_pool) as coon:
         if not autocommit:
             await coon.begin()
         try:
-            async with coon.cursor(aiomysql.DictCursor) as cur:
-                await cur.execute(sql.replace('?', '%s'), args)
-                affected = cur.rowcount
+            start = time.time()
+            affected = await _bounded(coon, run(coon), timeout, sql)
+            log(sql, args, time.time() - start, affected)
             if not autocommit:
                 await coon.commit()
         except BaseException:
-            if not autocommit:
+            #超时或取消时连接已经关闭，语句不会提交
+            if not autocommit and not coon.closed:
                 await coon.rollback()
-                raise
+            raise
         finally:
-            coon.close()
+            _bump_writes()
         return affected
 
 
+#批量写入：同一个连接、同一个事务里按chunk分批executemany
+#INSERT语句会被驱动改写成多行 INSERT ... VALUES (...), (...)，返回每一批的影响行数
+#timeout限制每一批executemany的时间
+async def execute_many(sql, seq_of_args, chunk=500, timeout=None):
+    sql = compile_sql(sql)
+    seq_of_args = list(seq_of_args)
+    counts = []
+    _mark_write()
+    #在transaction()中由事务统一提交
+    own = _current_tx.get() is None
+    async def run(cur, rows):
+        await cur.executemany(sql, rows)
+        return cur.rowcount
+    async with _connection(_primary_pool) as conn:
+        if own:
+            await conn.begin()
+        try:
+            async with conn.cursor() as cur:
+                for i in range(0, len(seq_of_args), chunk):
+                    start = time.time()
+                    rowcount = await _bounded(conn, run(cur, seq_of_args[i:i + chunk]), timeout, sql)
+                    counts.append(rowcount)
+                    log(sql, '<%s rows>'%len(seq_of_args[i:i + chunk]), time.time() - start, rowcount)
+            if own:
+                await conn.commit()
+        except BaseException:
+            #超时或取消时连接已经关闭，事务不会提交
+            if own and not conn.closed:
+                await conn.rollback()
+            raise
+        finally:
+            _bump_writes()
+    return counts
+
+
+#当前任务所在的事务
+_current_tx = contextvars.ContextVar('orm_transaction', default=None)
+
+#事务（unit of work）：async with orm.transaction() as tx: 里的select/execute都使用同一个主库连接，
+#正常退出时提交一次，出现异常（包括取消）时回滚；嵌套的transaction()并入最外层的事务
+#事务里的语句共用一个连接，不能在事务里用asyncio.gather并发执行查询
+class Transaction(object):
+    def __init__(self):
+        self.conn = None
+        #事务中写过的表，结束时再让结果缓存失效一次，避免其他请求在提交前缓存了旧数据
+        self.tables = set()
+        #事务中改动过的计数器，回滚时需要重建
+        self.counters = set()
+        self._pool = None
+        self._token = None
+        self._joined = False
+
+    async def __aenter__(self):
+        outer = _current_tx.get()
+        if outer is not None:
+            self._joined = True
+            return outer
+        _mark_write()
+        self._pool = _primary_pool()
+        self.conn = await self._pool.acquire()
+        try:
+            await self.conn.begin()
+        except BaseException:
+            self.conn.close()
+            await self._pool.release(self.conn)
+            raise
+        self._token = _current_tx.set(self)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self._joined:
+            return False
+        _current_tx.reset(self._token)
+        try:
+            if exc_type is None:
+                await self.conn.commit()
+            else:
+                #语句超时或被取消时连接已经关闭，服务器端的事务随之回滚
+                if not self.conn.closed:
+                    await self.conn.rollback()
+                for counter in self.counters:
+                    counter.invalidate()
+        except BaseException:
+            #提交或回滚没有完成，连接状态未知，关闭后再还给连接池
+            self.conn.close()
+            for counter in self.counters:
+                counter.invalidate()
+            raise
+        finally:
+            _bump_writes()
+            await self._pool.release(self.conn)
+            for table in self.tables:
+                invalidate(table)
+        return False
+
+def transaction():
+    '''async with orm.transaction() as tx: group statements on one connection and commit once.'''
+    return Transaction()
+
+
+#批量加载（DataLoader）：同一请求里、同一轮事件循环中发出的Model.load(key)合并成一条 where `col` in (...) 查询
+#结果按key缓存到请求结束，同一个key再次load直接返回同一个对象；写过这张表后（见invalidate）整张表的Loader作废
+class Loader(object):
+    #每批最多的key数，in列表的长度补齐到2的幂，语句形状（计划缓存、耗时统计）的数量有限
+    MAX_BATCH = 256
+
+    def __init__(self, cls, column):
+        self.cls = cls
+        self.column = column
+        #key ==> future
+        self.memo = dict()
+        self.pending = dict()
+
+    async def load(self, key):
+        fut = self.memo.get(key)
+        if fut is None:
+            loop = asyncio.get_event_loop()
+            fut = loop.create_future()
+            self.memo[key] = fut
+            #本轮第一个key：等这一轮里已经就绪的任务都执行过（各自登记了key）之后再发出查询
+            if not self.pending:
+                loop.call_soon(self._dispatch)
+            self.pending[key] = fut
+        #一个等待者被取消不应该取消其他等待同一个key的任务
+        return await asyncio.shield(fut)
+
+    def _dispatch(self):
+        pending, self.pending = self.pending, dict()
+        keys = list(pending)
+        for i in range(0, len(keys), self.MAX_BATCH):
+            batch = dict((k, pending[k]) for k in keys[i:i + self.MAX_BATCH])
+            asyncio.ensure_future(self._fetch(batch))
+
+    def _sql(self, n):
+        cls = self.cls
+        return cls.__plans__.get(('load', self.column, n), lambda: '%s where `%s` in (%s)'%(cls.__select__, self.column, create_args_string(n)))
+
+    async def _fetch(self, batch):
+        n, args = _pad_in(list(batch))
+        cls = self.cls
+        try:
+            rs = await _select(self._sql(n), args, tuples=True)
+        except BaseException as e:
+            #查询失败的key不缓存，下次load重新查
+            for k, fut in batch.items():
+                if self.memo.get(k) is fut:
+                    del self.memo[k]
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        found = dict()
+        for obj in cls._decoder(cls.__row__.__columns__)(rs):
+            found.setdefault(obj[self.column], obj)
+        for k, fut in batch.items():
+            if not fut.done():
+                fut.set_result(found.get(k))
+
+
+#in列表补齐到2的幂（用最后一个值填充），同一类查询的语句形状数量有限
+def _pad_in(keys):
+    n = 1
+    while n < len(keys):
+        n *= 2
+    return n, keys + keys[-1:] * (n - len(keys))
+
+
+#当前请求的Loader：(table, column) ==> Loader，由中间件通过bind_loaders开启
+__loaders = contextvars.ContextVar('orm_loaders', default=None)
+
+def bind_loaders():
+    '''start a request scope for Model.load batching and memoization.'''
+    return __loaders.set(dict())
+
+def _loader(cls, column):
+    loaders = __loaders.get()
+    if loaders is None:
+        return None
+    key = (cls.__table__, column)
+    loader = loaders.get(key)
+    if loader is None:
+        loader = loaders[key] = Loader(cls, column)
+    return loader
+
+#写过table之后，当前请求里这张表的Loader缓存的对象都可能过时
+def _forget_loaders(table):
+    loaders = __loaders.get()
+    if loaders:
+        for key in [key for key in loaders if key[0] == table]:
+            del loaders[key]
+
+
+_MISSING = object()
+
+#为Model生成取参数的函数：按fields的顺序从对象（dict）里取值，返回参数tuple，
+#defaults中的字段值为None时使用默认值并写回对象；默认值是否可调用在生成时就确定了，执行时不再判断
+#生成的函数形如：
+#    def insert_args(obj, _get=dict.get, _set=dict.__setitem__):
+#        v0 = _get(obj, 'name')
+#        v1 = _get(obj, 'id')
+#        if v1 is None:
+#            v1 = _d1()
+#            _set(obj, 'id', v1)
+#        return (v0, v1)
+def compile_args(name, fields, defaults=None):
+    defaults = defaults or dict()
+    env = dict()
+    lines = ['def %s(obj, _get=dict.get, _set=dict.__setitem__):'%name]
+    for i, k in enumerate(fields):
+        lines.append('    v%d = _get(obj, %r)'%(i, k))
+        if defaults.get(k) is not None:
+            default = defaults[k]
+            env['_d%d'%i] = default
+            lines.append('    if v%d is None:'%i)
+            lines.append('        v%d = _d%d%s'%(i, i, '()' if callable(default) else ''))
+            lines.append('        _set(obj, %r, v%d)'%(k, i))
+    lines.append('    return (%s)'%''.join('v%d, '%i for i in range(len(fields))))
+    exec('\n'.join(lines), env)
+    return env[name]
+
+
+#从数据库读出、还没有被修改过的对象共用的空脏字段集合，第一次修改时才换成对象自己的set
+_CLEAN = frozenset()
+
+#为一种语句形状（查询的列及其顺序）生成把元组行解码成对象的函数：元组按位置解包，不经过游标的dict和cls(**r)的参数dict
+#生成的函数形如：
+#    def decode(rows, _new=dict.__new__, _update=dict.update, _cls=Blog, _clean=_CLEAN):
+#        out = []
+#        append = out.append
+#        for v0, v1, in rows:
+#            obj = _new(_cls)
+#            _update(obj, {'id': v0, 'name': v1})
+#            obj.__dict__['_dirty'] = _clean
+#            append(obj)
+#        return out
+#compact为True时cls是紧凑行类型，值直接写进__slots__槽位：obj = _new(_cls); obj.id = v0; obj.name = v1
+def compile_decoder(cls, columns, compact=False):
+    env = dict(_cls=cls, _clean=_CLEAN)
+    names = ''.join('v%d, '%i for i in range(len(columns)))
+    lines = ['def decode(rows, _new=%s.__new__, _update=dict.update, _cls=_cls, _clean=_clean):'%('object' if compact else 'dict'),
+             '    out = []',
+             '    append = out.append',
+             '    for %sin rows:'%names,
+             '        obj = _new(_cls)']
+    if compact:
+        for i, k in enumerate(columns):
+            lines.append('        obj.%s = v%d'%(k, i))
+    else:
+        lines.append('        _update(obj, {%s})'%', '.join('%r: v%d'%(k, i) for i, k in enumerate(columns)))
+        lines.append("        obj.__dict__['_dirty'] = _clean")
+    lines.append('        append(obj)')
+    lines.append('    return out')
+    exec('\n'.join(lines), env)
+    return env['decode']
+
+
 #根据参数数量生成sql占位符‘？’列表
 def create_args_string(num):
     l = []
@@ -104,23 +1035,345 @@ class Field(object):
 #定义不同类型的派生Field，表的不同类的数据类型不一样
 class StringField(Field):
     def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100)'):
-        super.__init__(name, ddl, primary_key, default)
+        super().__init__(name, ddl, primary_key, default)
 
 class BoolField(Field):
     def __init__(self, name=None, defalut=False):
-        super.__init__(name, 'boolean', False, defalut)
+        super().__init__(name, 'boolean', False, defalut)
 
 class IntegerField(Field):
     def __init__(self, name=None, primary_key=False, default=0):
-        super.__init__(name, 'bigint', primary_key, default)
+        super().__init__(name, 'bigint', primary_key, default)
 
 class FloatField(Field):
     def __init__(self, name=None, primary_key=False, default=0.0):
-        super.__init__(name, 'real', primary_key, default)
+        super().__init__(name, 'real', primary_key, default)
 
 class TextField(Field):
     def __init__(self, name=None, default=None):
-        super.__init__(name, 'text', False, default)
+        super().__init__(name, 'text', False, default)
+
+#查询计划缓存：按查询的形状（列、where模板、orderBy、limit参数个数）缓存编译好的SQL
+#同一形状的查询只拼接一次SQL、只替换一次占位符，容量有限，按LRU淘汰
+class QueryPlanCache(object):
+    def __init__(self, capacity=64):
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._plans = OrderedDict()
+
+    def get(self, key, build):
+        '''return the compiled sql for key, calling build() to create it on a miss.'''
+        try:
+            sql = self._plans[key]
+        except KeyError:
+            self.misses += 1
+            sql = compile_sql(build())
+            self._plans[key] = sql
+            if len(self._plans) > self.capacity:
+                self._plans.popitem(last=False)
+            return sql
+        self.hits += 1
+        self._plans.move_to_end(key)
+        return sql
+
+    def clear(self):
+        self._plans.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def keys(self):
+        return list(self._plans.keys())
+
+    def stats(self):
+        return dict(size=len(self._plans), capacity=self.capacity, hits=self.hits, misses=self.misses)
+
+
+#行数计数器：在进程内维护表的总行数，以及按__counters__里声明的列分组的行数（如每个cat_id下的博客数）
+#rebuild()从数据库重建，之后由Model.save/remove增量维护；update可能改变分组列，只让分组计数过期
+#启用后过期的部分在下次用到时重建，重建期间有写操作则放弃结果；没有启用时findNumber照常执行COUNT
+#计数只反映本进程的写操作，多进程部署时其他进程的写入要等下次重建才能体现
+class RowCounter(object):
+    def __init__(self, table, primary_key, columns=()):
+        self.table = table
+        self.primary_key = primary_key
+        self.columns = tuple(columns)
+        self.enabled = False
+        self.total = None
+        #列名 ==> {列值: 行数}，没有的列表示已过期
+        self.groups = dict()
+        self.hits = 0
+        self._writes = 0
+
+    async def rebuild(self):
+        '''load the counts from the database and start serving findNumber from them.'''
+        self.enabled = True
+        await self._rebuild_total()
+        for col in self.columns:
+            await self._rebuild_group(col)
+
+    #重建总是读主库：副本可能落后，落后的计数作为基数，之后的增量都会算在错误的基数上
+    async def _rebuild_total(self):
+        writes = self._writes
+        rs = await _query(compile_sql('select count(*) _num_ from `%s`'%self.table), None, 1, pool=_primary_pool)
+        if writes == self._writes:
+            self.total = rs[0]['_num_']
+
+    async def _rebuild_group(self, col):
+        writes = self._writes
+        rs = await _query(compile_sql('select `%s` _key_, count(*) _num_ from `%s` group by `%s`'%(col, self.table, col)), None, pool=_primary_pool)
+        if writes == self._writes:
+            self.groups[col] = dict((r['_key_'], r['_num_']) for r in rs)
+
+    def add(self, obj, delta):
+        tx = _current_tx.get()
+        if tx is not None:
+            tx.counters.add(self)
+        self._writes += 1
+        if self.total is not None:
+            self.total += delta
+        for col, counts in self.groups.items():
+            key = obj.get(col)
+            counts[key] = counts.get(key, 0) + delta
+
+    def invalidate(self, groups_only=False):
+        tx = _current_tx.get()
+        if tx is not None:
+            tx.counters.add(self)
+        self._writes += 1
+        self.groups.clear()
+        if not groups_only:
+            self.total = None
+
+    #findNumber的形状是否能由计数器回答：count(*)/count(主键)，不带条件或者只有一个'列=?'条件
+    def _shape(self, selectField, where, args):
+        if selectField.replace('`', '').replace(' ', '') not in ('count(*)', 'count(%s)'%self.primary_key):
+            return None
+        if not where:
+            return ''
+        for col in self.columns:
+            if where.replace('`', '').replace(' ', '') == '%s=?'%col and args and len(args) == 1:
+                return col
+        return None
+
+    async def count(self, selectField, where, args):
+        '''the maintained count for this query shape, or None if the database has to be asked.'''
+        if not self.enabled:
+            return None
+        col = self._shape(selectField, where, args)
+        if col is None:
+            return None
+        if col == '':
+            if self.total is None:
+                await self._rebuild_total()
+            n = self.total
+        else:
+            if col not in self.groups:
+                await self._rebuild_group(col)
+            n = self.groups[col].get(args[0], 0) if col in self.groups else None
+        if n is not None:
+            self.hits += 1
+        return n
+
+    def stats(self):
+        return dict(table=self.table, enabled=self.enabled, total=self.total, groups=dict((k, len(v)) for k, v in self.groups.items()), hits=self.hits)
+
+
+async def rebuild_counters(*models):
+    '''rebuild the row counters of models from the database, call once on startup.'''
+    for model in models:
+        await model.__counter__.rebuild()
+
+
+#写回缓冲的计数列（如浏览次数）：add只在内存里累加，每interval秒把累计值一次性写回
+#update `t` set `col` = `col` + ? where `pk` = ?，所有行在同一个事务里用executemany批量执行
+#写回失败时增量放回缓冲区下次再写；close时停止定时任务并写回剩余的增量
+class WriteBehindCounter(object):
+    def __init__(self, cls, column, interval=5, max_pending=10000):
+        self.cls = cls
+        self.column = column
+        self.interval = interval
+        #缓冲的行数超过max_pending时立即写回一次
+        self.max_pending = max_pending
+        #主键 ==> 尚未写回的增量
+        self.pending = dict()
+        self.flushes = 0
+        self.flushed = 0
+        self._task = None
+        self._flushing = None
+        self._sql = 'update `%s` set `%s` = `%s` + ? where `%s` = ?'%(cls.__table__, column, column, cls.__primary_key__)
+
+    def start(self):
+        '''start the periodic flush, call after create_pool.'''
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self._try_flush()
+
+    async def _try_flush(self):
+        try:
+            await self.flush()
+        except Exception as e:
+            logging.warning('flush %s.%s failed: %s'%(self.cls.__table__, self.column, e))
+
+    def add(self, pk, n=1):
+        self.pending[pk] = self.pending.get(pk, 0) + n
+        if len(self.pending) >= self.max_pending and self._flushing is None:
+            asyncio.ensure_future(self._try_flush())
+
+    def get(self, pk):
+        '''increments of pk not yet written to the database.'''
+        return self.pending.get(pk, 0)
+
+    async def flush(self):
+        '''write the buffered increments to the database.'''
+        #同一时间只有一次写回，后来的调用等它完成后再写新的增量
+        while self._flushing is not None:
+            await asyncio.shield(self._flushing)
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, dict()
+        self._flushing = asyncio.get_event_loop().create_future()
+        try:
+            await execute_many(self._sql, [(n, pk) for pk, n in pending.items()])
+        except BaseException:
+            for pk, n in pending.items():
+                self.pending[pk] = self.pending.get(pk, 0) + n
+            raise
+        else:
+            self.flushes += 1
+            self.flushed += sum(pending.values())
+            #计数是近似值，页面会加上还没写回的部分，只让这几行的find缓存失效，列表等其他缓存结果照常使用
+            invalidate_rows(self.cls, pending)
+        finally:
+            self._flushing.set_result(None)
+            self._flushing = None
+
+    async def close(self):
+        '''stop the periodic flush and write what is left, call before close_pool.'''
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    def stats(self):
+        return dict(table=self.cls.__table__, column=self.column, pending=len(self.pending),
+                    flushes=self.flushes, flushed=self.flushed)
+
+
+#由Model的映射生成建表语句，MySQL的索引直接写在create table里
+#SQLite不支持在create table里写普通索引，需要再用create_index_sql逐个创建
+def create_table_sql(cls):
+    lines = []
+    for k in (cls.__primary_key__,) + tuple(cls.__fields__):
+        field = cls.__mappings__[k]
+        lines.append('    `%s` %s%s'%(k, field.column_type, ' not null' if field.primary_key else ''))
+    lines.append('    primary key (`%s`)'%cls.__primary_key__)
+    if __backend == 'sqlite':
+        return 'create table if not exists `%s` (\n%s\n)'%(cls.__table__, ',\n'.join(lines))
+    for name, columns, unique in cls.__indexes__:
+        lines.append('    %s `%s` (%s)'%('unique key' if unique else 'key', name, ', '.join('`%s`'%c for c in columns)))
+    return 'create table if not exists `%s` (\n%s\n) engine=innodb default charset=utf8mb4'%(cls.__table__, ',\n'.join(lines))
+
+#给已经存在的表补建索引的语句，SQLite的索引名在整个库内唯一，要加上表名前缀
+def create_index_sql(cls, index):
+    name, columns, unique = index
+    if __backend == 'sqlite':
+        name = '%s_%s'%(cls.__table__, name)
+    return 'create %sindex `%s` on `%s` (%s)'%('unique ' if unique else '', name, cls.__table__, ', '.join('`%s`'%c for c in columns))
+
+async def live_indexes(cls):
+    '''indexes that exist on the table in the database, as {name: (columns, unique)}.'''
+    if __backend == 'sqlite':
+        indexes = dict()
+        for r in await select('pragma index_list(`%s`)'%cls.__table__, None):
+            rs = await select('pragma index_info(`%s`)'%r['name'], None)
+            indexes[r['name']] = (tuple(c['name'] for c in sorted(rs, key=lambda c: c['seqno'])), bool(r['unique']))
+        return indexes
+    rs = await select('select `index_name` _name_, `column_name` _column_, `non_unique` _non_unique_ from information_schema.statistics '
+                      'where `table_schema` = database() and `table_name` = ? order by `index_name`, `seq_in_index`', [cls.__table__])
+    indexes = dict()
+    for r in rs:
+        columns, unique = indexes.get(r['_name_'], ((), not r['_non_unique_']))
+        indexes[r['_name_']] = (columns + (r['_column_'],), unique)
+    return indexes
+
+#where模板里用=比较的列，以及orderBy的第一列
+_RE_EQ = re.compile(r'`?(\w+)`?\s*=\s*\?')
+_RE_ORDER = re.compile(r'^\s*`?(\w+)`?')
+
+#一个查询模式(where模板, orderBy)用到的索引列，where里没有可用的列时返回None
+def pattern_columns(cls, where, orderBy=None):
+    columns = [c for c in _RE_EQ.findall(where or '') if c in cls.__mappings__]
+    if not columns:
+        return None
+    m = _RE_ORDER.match(orderBy or '')
+    if m and m.group(1) in cls.__mappings__ and m.group(1) not in columns:
+        columns.append(m.group(1))
+    return tuple(columns)
+
+#ORM查询模式需要的索引：keyset分页的排序键、分组计数列、调用方声明的查询模式patterns，以及查询计划缓存里出现过的where条件
+#计划缓存只在运行中的进程里有内容，schema.py check这样的独立进程要通过patterns传入静态扫描出的查询模式
+def required_indexes(cls, patterns=()):
+    needed = [tuple(cls.__seek__)]
+    for col in cls.__counter__.columns:
+        needed.append((col,))
+    patterns = list(patterns)
+    for key in cls.__plans__.keys():
+        if key[0] == 'findall':
+            patterns.append((key[2], key[3]))
+        elif key[0] == 'iterate':
+            patterns.append((key[1], key[2]))
+        elif key[0] == 'findNumber':
+            patterns.append((key[2], None))
+    for where, orderBy in patterns:
+        columns = pattern_columns(cls, where, orderBy)
+        if columns and columns not in needed:
+            needed.append(columns)
+    return needed
+
+def missing_indexes(cls, indexes=None, patterns=()):
+    '''query patterns of cls that no index serves; indexes defaults to the declared ones, pass live_indexes() to check the database.'''
+    if indexes is None:
+        indexes = dict((name, (columns, unique)) for name, columns, unique in cls.__indexes__)
+    available = [(cls.__primary_key__,)] + [columns for columns, unique in indexes.values()]
+    #索引的前几列正好是需要的列（顺序不限）时可以使用这个索引
+    return [columns for columns in required_indexes(cls, patterns)
+            if not any(set(index[:len(columns)]) == set(columns) for index in available)]
+
+
+#紧凑的行对象：ModelMetaclass为每个Model生成一个Row子类，每个映射字段占一个__slots__槽位
+#比dict子类的Model实例小得多，属性访问直接走槽位描述符，没有__getattr__和异常处理
+#额外的'__dict__'槽位只在handler给行对象添加其他属性（如html_summary）时才会分配
+class Row(object):
+    __slots__ = ()
+    __columns__ = ()
+
+    def __init__(self, **kwargs):
+        for k, v in kwargs.items():
+            setattr(self, k, v)
+
+    def keys(self):
+        keys = [k for k in self.__columns__ if hasattr(self, k)]
+        keys.extend(getattr(self, '__dict__', ()))
+        return keys
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def to_dict(self):
+        '''plain dict for json.dumps.'''
+        return dict((k, getattr(self, k)) for k in self.keys())
+
+    def __repr__(self):
+        return '<%s %s>'%(self.__class__.__name__, self.to_dict())
+
 
 #定义model的元类
 #所有的元类都继承自type，ModelMetaclass元类定义了所有Model基类（继承ModelMetaclass）的子类实现的操作
@@ -157,10 +1410,11 @@ class ModelMetaclass(type):
                 logging.info('Found mapping:%s==>%s'%(k, v))
                 mappings[k] = v
                 if v.primary_key:
-                    raise BaseException('Douplicate primary key for field : %s'%k)
-                primaryKey = k
-            else:
-                fields.append(k)
+                    if primaryKey:
+                        raise BaseException('Douplicate primary key for field : %s'%k)
+                    primaryKey = k
+                else:
+                    fields.append(k)
         if not primaryKey:
             raise BaseException('primary key not found')
 
@@ -180,9 +1434,47 @@ class ModelMetaclass(type):
         #构造默认的select，insert，update语句
         #``反引号功能同repr（）
         attrs['__select__'] = 'select `%s`, %s from `%s`'%(primaryKey, ', '.join(escaped_field), tableName)
-        attrs['__insert__'] = 'insert into `%s` (%s, `%s`) VALUE (%s)' %(tableName, ', '.join(escaped_field), primaryKey, create_args_string(len(escaped_field) + 1))
+        attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values (%s)' %(tableName, ', '.join(escaped_field), primaryKey, create_args_string(len(escaped_field) + 1))
         attrs['__update__'] = 'update `%s` set %s WHERE `%s`=?'%(tableName, ', '.join(map(lambda f:'`%s`=?'%(mappings.get(f).name or f ), fields)), primaryKey)
         attrs['__delete__'] = 'delete from `%s` WHERE `%s`=?'%(tableName, primaryKey)
+        #与上面三条语句的参数顺序一致的取参数函数，insert同时填入默认值
+        attrs['__insert_args__'] = compile_args('insert_args', fields + [primaryKey], dict((k, f.default) for k, f in mappings.items()))
+        attrs['__update_args__'] = compile_args('update_args', fields + [primaryKey])
+        attrs['__delete_args__'] = compile_args('delete_args', [primaryKey])
+        #只写部分字段的update语句各自的取参数函数，按字段组合缓存
+        attrs['__partial_update_args__'] = dict()
+        #按语句形状（列的tuple）缓存的元组行解码函数
+        attrs['__decoders__'] = dict()
+        #索引声明：__indexes__是普通索引、__unique__是唯一索引，每项是列名或者列名的tuple（联合索引）
+        indexes = []
+        for unique, declared in ((False, attrs.get('__indexes__', ())), (True, attrs.get('__unique__', ()))):
+            for columns in declared:
+                columns = (columns,) if isinstance(columns, str) else tuple(columns)
+                for c in columns:
+                    if c not in mappings:
+                        raise BaseException('index column %s is not a field of %s'%(c, name))
+                indexes.append(('%s_%s'%('uniq' if unique else 'idx', '_'.join(columns)), columns, unique))
+        attrs['__indexes__'] = indexes
+        #keyset分页使用的排序键，默认(created_at, 主键)
+        attrs['__seek__'] = attrs.get('__seek__', None) or ('created_at', primaryKey)
+        #延迟加载的字段：findall默认不查询，需要时用undefer/load_deferred补查；没有声明时TEXT列都延迟加载
+        deferred = attrs.get('__deferred__', None)
+        if deferred is None:
+            deferred = [k for k in fields if isinstance(mappings[k], TextField)]
+        for k in deferred:
+            if k not in fields:
+                raise BaseException('deferred field %s is not a field of %s'%(k, name))
+        attrs['__deferred__'] = tuple(deferred)
+        #列表页使用的紧凑行类型
+        columns = tuple([primaryKey] + fields)
+        attrs['__list_columns__'] = tuple(c for c in columns if c not in deferred)
+        attrs['__row__'] = type('%sRow'%name, (Row,), dict(__slots__=columns + ('__dict__',), __columns__=columns))
+        #__cache__ = True的Model查询结果进入结果缓存，按表名打标签
+        attrs['__cache_table__'] = tableName if attrs.get('__cache__', False) else None
+        #行数计数器，__counters__声明需要按值分组计数的列
+        attrs['__counter__'] = RowCounter(tableName, primaryKey, attrs.get('__counters__', ()))
+        #每个Model类各自持有一份查询计划缓存
+        attrs['__plans__'] = QueryPlanCache(attrs.get('__plan_cache_size__', 64))
         return type.__new__(cls, name, bases, attrs)
 
 # 定义ORM所有映射的基类：Model
@@ -202,100 +1494,326 @@ class Model(dict, metaclass=ModelMetaclass):
         try:
             return self[key]
         except:
+            if key in self.__deferred__:
+                raise AttributeError(r'deferred field "%s" is not loaded, await load_deferred() first'%key)
             raise AttributeError(r'"Model" object has no attribute "%s"'%key)
 
     def __setattr__(self, key, value):
         self[key] = value
 
-    def getValueOrDefault(self, key):
-        value = getattr(self, key, None)
-        if value is None:
-            field = self.__mapping__[key]
-            if field.default is not None:
-                value = field.default() if callable(field.default) else field.default
-                logging.debug('using default value for %s : %s '%(key, str(value)))
-                setattr(self, key, value)
-        return value
+    #从数据库读出的对象记录哪些映射字段被改过（脏字段），update只写这些列
+    #用户自己构造的对象_dirty为None，update写回全部字段
+    def __setitem__(self, key, value):
+        dirty = self.__dict__.get('_dirty')
+        if dirty is not None and key in self.__mappings__ and self.get(key, _MISSING) != value:
+            if dirty is _CLEAN:
+                dirty = self.__dict__['_dirty'] = set()
+            dirty.add(key)
+        dict.__setitem__(self, key, value)
+
+    @classmethod
+    def _decoder(cls, columns, compact=False):
+        '''decoding function for tuple rows with these columns, compiled once per statement shape.'''
+        decoders = cls.__decoders__
+        decode = decoders.get((columns, compact))
+        if decode is None:
+            if len(decoders) >= 64:
+                decoders.clear()
+            decode = decoders[(columns, compact)] = compile_decoder(cls.__row__ if compact else cls, columns, compact)
+        return decode
+
+    def dirty_fields(self):
+        '''mapped fields changed since the object was loaded or saved, None when not tracked.'''
+        dirty = self.__dict__.get('_dirty')
+        return None if dirty is None else set(dirty)
+
+    @classmethod
+    def plan_stats(cls):
+        '''hit/miss counters of the compiled query plan cache.'''
+        return cls.__plans__.stats()
 
     @classmethod
     async def findall(cls, col = None, where = None, args = None, **kwargs):
-        '''find object by where clause.'''
-        # sql = [cls.__select__]
-        if col is None:
-            sql = [cls.__select__]
-        else:
-            _select = 'select `%s` from `%s`'%('`, `'.join(col), cls.__table__)
-            sql = [cls._select]
+        '''find object by where clause, compact=True returns read-only slotted rows instead of models.
 
-        if where:
-            sql.append('where')
-            sql.append(where)
+        timeout=seconds overrides the statement timeout of this query.
 
-        if args is None:
-            args = []
+        Deferred fields (__deferred__) are not selected unless undefer=True or undefer=(names);
+        load them later with undefer() / load_deferred().
 
+        after=(created_at, id) / before=(created_at, id) switch to keyset pagination on __seek__:
+        rows strictly older / newer than the key, newest first, orderBy is ignored.
+        '''
         orderBy = kwargs.get('orderBy', None)#语句中是否有orderby参数
-        if orderBy:
-            sql.append('order by')
-            sql.append(orderBy)
-
         limit = kwargs.get('limit', None)
-        if limit is not None:
-            sql.append('limit')
-            if isinstance(limit, int):
-                sql.append('?')
-                args.append(limit)
-            elif isinstance(limit, tuple) and len(limit) == 2:
-                sql.append('?,?')
-                sql.extend(limit)
+        args = list(args) if args else []
+        #keyset分页：按(created_at, id)定位，不论翻到多深都只扫描limit行
+        seek = None
+        if kwargs.get('after') is not None:
+            seek = 'after'
+        elif kwargs.get('before') is not None:
+            seek = 'before'
+        if seek:
+            value, pk = kwargs[seek]
+            args.extend([value, value, pk])
+        if limit is None:
+            arity = 0
+        elif isinstance(limit, int):
+            arity = 1
+            args.append(limit)
+        elif isinstance(limit, tuple) and len(limit) == 2:
+            arity = 2
+            args.extend(limit)
+        else:
+            raise ValueError('Invalid limit value:%s'%str(limit))
+        if col is not None:
+            col = tuple(col)
+        elif cls.__deferred__:
+            undefer = kwargs.get('undefer', False)
+            if undefer is not True:
+                col = cls.__list_columns__
+                if undefer:
+                    col = tuple(c for c in cls.__row__.__columns__ if c in col or c in undefer)
+
+        def build():
+            if col is None:
+                sql = [cls.__select__]
+            else:
+                sql = ['select `%s` from `%s`'%('`, `'.join(col), cls.__table__)]
+            conditions = []
+            if where:
+                conditions.append('(%s)'%where if seek else where)
+            if seek:
+                key, pk = cls.__seek__
+                op = '<' if seek == 'after' else '>'
+                conditions.append('(`%s` %s ? or (`%s` = ? and `%s` %s ?))'%(key, op, key, pk, op))
+                order = 'desc' if seek == 'after' else 'asc'
+                ordering = '`%s` %s, `%s` %s'%(key, order, pk, order)
             else:
-                raise ValueError('Invalid limit value:%s'%str(limit))
-        logging.info('sql:%s'%sql)
-        logging.info('args:%s'%args)
-        rs = await select(' '.join(sql), args)
-        return [cls(**r) for r in rs ]
+                ordering = orderBy
+            if conditions:
+                sql.append('where')
+                sql.append(' and '.join(conditions))
+            if ordering:
+                sql.append('order by')
+                sql.append(ordering)
+            if arity:
+                sql.append('limit')
+                sql.append(create_args_string(arity))
+            return ' '.join(sql)
+
+        sql = cls.__plans__.get(('findall', col, where, None if seek else orderBy, arity, seek), build)
+        rs = await _cached_select(cls.__cache_table__, sql, args, None, kwargs.get('timeout'), tuples=True)
+        rs = cls._decoder(cls.__row__.__columns__ if col is None else col, kwargs.get('compact', False))(rs)
+        #before是按升序取的，翻转回最新的在前
+        if seek == 'before':
+            rs.reverse()
+        return rs
+
+    @classmethod
+    async def iterate(cls, where = None, args = None, batch = 100, **kwargs):
+        '''stream objects in lists of at most batch rows over a server-side cursor.'''
+        orderBy = kwargs.get('orderBy', None)
+
+        def build():
+            sql = [cls.__select__]
+            if where:
+                sql.append('where')
+                sql.append(where)
+            if orderBy:
+                sql.append('order by')
+                sql.append(orderBy)
+            return ' '.join(sql)
+
+        sql = cls.__plans__.get(('iterate', where, orderBy), build)
+        decode = cls._decoder(cls.__row__.__columns__)
+        rows = iterate(sql, args, batch, tuples=True)
+        try:
+            async for rs in rows:
+                yield decode(rs)
+        finally:
+            await rows.aclose()
 
     @classmethod
     async def findNumber(cls, selectField, where = None, args = None):
-        '''find number by select and where '''
-        # 这里的 _num_ 为别名，任何客户端都可以按照这个名称引用这个列，就像它是个实际的列一样
-        sql = ['select %s _num_ from `%s` '% (selectField , cls.__table__)]
-
-        if where:
-            sql.append('where')
-            sql.append(where)
-        rs = await select(' '.join(sql),args, 1)
+        '''find number by select and where, answered from the row counter when the shape matches.'''
+        # '*'表示统计行数
+        if selectField == '*':
+            selectField = 'count(*)'
+        n = await cls.__counter__.count(selectField, where, args)
+        if n is not None:
+            return n
+
+        def build():
+            # 这里的 _num_ 为别名，任何客户端都可以按照这个名称引用这个列，就像它是个实际的列一样
+            sql = ['select %s _num_ from `%s`'% (selectField , cls.__table__)]
+            if where:
+                sql.append('where')
+                sql.append(where)
+            return ' '.join(sql)
+
+        sql = cls.__plans__.get(('findNumber', selectField, where), build)
+        rs = await _cached_select(cls.__cache_table__, sql, args, 1)
         if len(rs) == 0:
             return None
         # rs[0]表示一行数据,是一个字典，而rs是一个列表
         return rs[0]['_num_']
 
+    @classmethod
+    def _find_sql(cls):
+        return cls.__plans__.get(('find',), lambda: '%s where `%s`=?'%(cls.__select__, cls.__primary_key__))
+
     @classmethod
     async def find(cls, pk):
         '''find object by primary key.'''
-        rs = await select('%s where `%s`=?'%(cls.__select__, cls.__primary_key__), [pk], 1)
+        rs = await _cached_select(cls.__cache_table__, cls._find_sql(), [pk], 1, tuples=True)
         if len(rs) ==0:
             return None
-        # 1.将rs[0]转换成关键字参数元组，rs[0]为dict
-        # 2.通过<class '__main__.User'>(位置参数元组)，产生一个实例对象
-        return cls(**rs[0])
+        # rs[0]是按__select__的列顺序排列的元组，按这个语句形状解码成实例对象
+        return cls._decoder(cls.__row__.__columns__)(rs)[0]
+
+    @classmethod
+    async def load(cls, key, column=None):
+        '''find object by primary key (or by column), batched with the other loads of this tick and memoized for the request.
+
+        Every load of the same key in a request returns the same object: treat it as shared and do not
+        change it unless the change is meant to be saved.
+        '''
+        column = column or cls.__primary_key__
+        loader = _loader(cls, column)
+        #没有请求作用域或处于事务中（事务的连接不能并发使用）时直接查询
+        if loader is None or _current_tx.get() is not None:
+            if column == cls.__primary_key__:
+                return await cls.find(key)
+            rs = await cls.findall(where='`%s`=?'%column, args=[key], limit=1)
+            return rs[0] if rs else None
+        return await loader.load(key)
 
     async def save(self):
-        args = list(map(self.getValueOrDefault, self.__fields__))
-        args.append(self.getValueOrDefault(self.__primary_key__))
-        rows = await execute(self.__insert__, args)
+        rows = await execute(self.__insert__, self.__insert_args__())
+        self.__dict__['_dirty'] = set()
+        invalidate(self.__table__)
+        if rows == 1:
+            self.__counter__.add(self, 1)
         if rows != 1:
             logging.warning('Field to insert record :affected rows: %s'%rows)
 
+    @classmethod
+    async def undefer(cls, objs, *names):
+        '''load deferred fields (all of them by default) of models or rows returned by findall, one query per batch.'''
+        names = tuple(names or cls.__deferred__)
+        pk = cls.__primary_key__
+        todo = dict()
+        for obj in objs:
+            if any(getattr(obj, k, _MISSING) is _MISSING for k in names):
+                todo.setdefault(getattr(obj, pk), []).append(obj)
+        keys = list(todo)
+        for i in range(0, len(keys), Loader.MAX_BATCH):
+            n, args = _pad_in(keys[i:i + Loader.MAX_BATCH])
+            sql = cls.__plans__.get(('undefer', names, n), lambda: 'select `%s`, %s from `%s` where `%s` in (%s)'%(
+                pk, ', '.join('`%s`'%k for k in names), cls.__table__, pk, create_args_string(n)))
+            for r in await _cached_select(cls.__cache_table__, sql, args):
+                for obj in todo.get(r[pk], ()):
+                    for k in names:
+                        #补查的值不是修改，不记为脏字段
+                        if isinstance(obj, dict):
+                            dict.__setitem__(obj, k, r[k])
+                        else:
+                            setattr(obj, k, r[k])
+
+    async def load_deferred(self, *names):
+        '''load the deferred fields of this object that findall skipped.'''
+        await self.undefer([self], *names)
+
+    #update要写的字段：从数据库读出的对象只写脏字段；其他对象写全部字段，但没有加载的延迟字段不写，避免把它们更新成NULL
+    #每种字段组合的语句缓存在查询计划缓存里，取参数函数缓存在__partial_update_args__里；没有要写的字段时返回(None, None)
+    def _update_plan(self):
+        dirty = self.__dict__.get('_dirty')
+        if dirty is None:
+            fields = tuple(k for k in self.__fields__ if k in self or k not in self.__deferred__)
+        else:
+            fields = tuple(k for k in self.__fields__ if k in dirty)
+        if not fields:
+            return None, None
+        if len(fields) == len(self.__fields__):
+            #经类取出的是普通函数，和部分字段的build一样由调用方传入对象
+            return self.__update__, type(self).__update_args__
+        sql = self.__plans__.get(('update', fields), lambda: 'update `%s` set %s where `%s`=?'%(
+            self.__table__, ', '.join('`%s`=?'%k for k in fields), self.__primary_key__))
+        builders = self.__partial_update_args__
+        build = builders.get(fields)
+        if build is None:
+            if len(builders) >= 64:
+                builders.clear()
+            build = builders[fields] = compile_args('update_args', fields + (self.__primary_key__,))
+        return sql, build
+
     async def update(self):
-        args = list(map(self.getValue, self.__fields__))
-        args.append(self.getValue(self.__primary_key__))
-        rows = await execute(self.__update__, args)
+        sql, build = self._update_plan()
+        if sql is None:
+            return
+        rows = await execute(sql, build(self))
+        self.__dict__['_dirty'] = set()
+        invalidate(self.__table__)
+        self.__counter__.invalidate(groups_only=True)
         if rows != 1:
             logging.warning('Field to update by primary key:affected rows: %s'%rows)
 
     async def remove(self):
-        args = [self.getValue(self.__primary_key__)]
-        rows = await execute(self.__delete__, args)
+        rows = await execute(self.__delete__, self.__delete_args__())
+        invalidate(self.__table__)
+        if rows == 1:
+            self.__counter__.add(self, -1)
         if rows != 1:
-            logging.warning('Field to remove by primary key :affected rows: %s'%rows)
\ No newline at end of file
+            logging.warning('Field to remove by primary key :affected rows: %s'%rows)
+
+    @classmethod
+    async def removeall(cls, where, args = None):
+        '''delete every row matching where, return the number of rows deleted.'''
+        rows = await execute('delete from `%s` where %s'%(cls.__table__, where), args)
+        invalidate(cls.__table__)
+        if rows:
+            cls.__counter__.invalidate()
+        return rows
+
+    @classmethod
+    async def save_many(cls, objs, chunk = 500):
+        '''insert objs in chunks on one connection and one transaction, return affected rows per chunk.'''
+        counts = await execute_many(cls.__insert__, list(map(cls.__insert_args__, objs)), chunk)
+        invalidate(cls.__table__)
+        for obj in objs:
+            obj.__dict__['_dirty'] = set()
+            cls.__counter__.add(obj, 1)
+        return counts
+
+    @classmethod
+    async def update_many(cls, objs, chunk = 500):
+        '''update objs by primary key in chunks, return affected rows per chunk.'''
+        #按要写的字段组合分组，每组一条update语句，没有改动的对象不写
+        groups = dict()
+        for obj in objs:
+            sql, build = obj._update_plan()
+            if sql is not None:
+                groups.setdefault(sql, []).append(build(obj))
+        counts = []
+        for sql, rows in groups.items():
+            counts.extend(await execute_many(sql, rows, chunk))
+        for obj in objs:
+            obj.__dict__['_dirty'] = set()
+        invalidate(cls.__table__)
+        cls.__counter__.invalidate(groups_only=True)
+        return counts
+
+    @classmethod
+    async def remove_many(cls, objs, chunk = 500):
+        '''delete objs by primary key in chunks, return affected rows per chunk.'''
+        rows = list(map(cls.__delete_args__, objs))
+        counts = await execute_many(cls.__delete__, rows, chunk)
+        invalidate(cls.__table__)
+        #有的行可能早已不存在，无法确定每个分组减少多少，整体重建
+        if sum(counts) == len(rows):
+            for obj in objs:
+                cls.__counter__.add(obj, -1)
+        else:
+            cls.__counter__.invalidate()
+        return counts
@@ -0,0 +1,249 @@
+'''
+SQLite backend for orm: the subset of the aiomysql pool/connection/cursor API that orm uses, over the standard sqlite3 module.
+
+Every connection owns one worker thread, all sqlite3 calls of that connection run there,
+so the event loop never blocks on disk I/O. Connections are opened in WAL mode so readers do not block the writer.
+'''
+import asyncio
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+__author__ = 'cjh'
+
+# 与aiomysql同名的游标类型，sqlite3的游标本来就是逐行读取的，流式游标与普通游标的行为相同
+# 不指定游标类型时每行是元组
+DictCursor = 'DictCursor'
+SSDictCursor = 'SSDictCursor'
+SSCursor = 'SSCursor'
+
+
+# orm按aiomysql的习惯使用'%s'占位符，这里换回sqlite3的'?'
+def _convert(sql, args):
+    if args:
+        return sql.replace('%s', '?').replace('%%', '%')
+    return sql
+
+
+class Cursor(object):
+    def __init__(self, conn, kind):
+        self._conn = conn
+        self._kind = kind
+        self._cur = None
+        self.rowcount = -1
+        self.description = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def execute(self, sql, args=None):
+        def run():
+            cur = self._conn._db.cursor()
+            cur.execute(_convert(sql, args), tuple(args or ()))
+            return cur
+        self._cur = await self._conn._run(run)
+        self.rowcount = self._cur.rowcount
+        self.description = self._cur.description
+        return self.rowcount
+
+    async def executemany(self, sql, seq_of_args):
+        seq_of_args = [tuple(args) for args in seq_of_args]
+        def run():
+            cur = self._conn._db.cursor()
+            cur.executemany(_convert(sql, True), seq_of_args)
+            return cur
+        self._cur = await self._conn._run(run)
+        self.rowcount = self._cur.rowcount
+        return self.rowcount
+
+    def _rows(self, rs):
+        if self._kind in (DictCursor, SSDictCursor):
+            names = [d[0] for d in self.description]
+            return [dict(zip(names, r)) for r in rs]
+        return rs
+
+    async def fetchone(self):
+        rs = await self.fetchmany(1)
+        return rs[0] if rs else None
+
+    async def fetchmany(self, size=1):
+        if self._cur is None or self.description is None:
+            return []
+        return self._rows(await self._conn._run(self._cur.fetchmany, size))
+
+    async def fetchall(self):
+        if self._cur is None or self.description is None:
+            return []
+        return self._rows(await self._conn._run(self._cur.fetchall))
+
+    async def close(self):
+        if self._cur is not None:
+            cur, self._cur = self._cur, None
+            # 连接已经关闭时游标随连接一起释放
+            if not self._conn.closed:
+                await self._conn._run(cur.close)
+
+
+class Connection(object):
+    def __init__(self, path, loop):
+        self._path = path
+        self._loop = loop
+        self._db = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self.closed = False
+
+    async def _connect(self):
+        def run():
+            # isolation_level=None：自动提交，事务由begin()显式开始
+            db = sqlite3.connect(self._path, isolation_level=None, check_same_thread=False)
+            db.execute('pragma journal_mode=WAL')
+            db.execute('pragma synchronous=NORMAL')
+            db.execute('pragma busy_timeout=5000')
+            return db
+        self._db = await self._run(run)
+        return self
+
+    async def _run(self, fn, *args):
+        return await self._loop.run_in_executor(self._executor, fn, *args)
+
+    def cursor(self, kind=None):
+        return _CursorContext(self, kind)
+
+    async def begin(self):
+        await self._run(self._db.execute, 'begin')
+
+    async def commit(self):
+        if self._db.in_transaction:
+            await self._run(self._db.execute, 'commit')
+
+    async def rollback(self):
+        if self._db.in_transaction:
+            await self._run(self._db.execute, 'rollback')
+
+    # 中断正在执行的语句，可以在其他线程里调用，被中断的语句抛出OperationalError
+    def interrupt(self):
+        if self._db is not None and not self.closed:
+            self._db.interrupt()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self._db is not None:
+            self._executor.submit(self._db.close)
+        self._executor.shutdown(wait=False)
+
+    async def ensure_closed(self):
+        self.close()
+
+
+# 与aiomysql一样，conn.cursor()既可以await也可以async with
+class _CursorContext(object):
+    def __init__(self, conn, kind):
+        self._cursor = Cursor(conn, kind)
+
+    def __await__(self):
+        async def cursor():
+            return self._cursor
+        return cursor().__await__()
+
+    async def __aenter__(self):
+        return self._cursor
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._cursor.close()
+
+
+class Pool(object):
+    def __init__(self, path, minsize, maxsize, loop):
+        self._path = path
+        self._loop = loop
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self._free = []
+        self._used = set()
+        self._cond = asyncio.Condition()
+        self._closed = False
+
+    @property
+    def size(self):
+        return len(self._free) + len(self._used)
+
+    @property
+    def freesize(self):
+        return len(self._free)
+
+    async def _fill(self):
+        while self.size < self.minsize:
+            self._free.append(await Connection(self._path, self._loop)._connect())
+
+    async def acquire(self):
+        async with self._cond:
+            while True:
+                while self._free:
+                    conn = self._free.pop()
+                    if not conn.closed:
+                        self._used.add(conn)
+                        return conn
+                if self.size < self.maxsize:
+                    conn = Connection(self._path, self._loop)
+                    self._used.add(conn)
+                    try:
+                        return await conn._connect()
+                    except BaseException:
+                        self._used.discard(conn)
+                        conn.close()
+                        raise
+                await self._cond.wait()
+
+    async def release(self, conn):
+        self._used.discard(conn)
+        if not conn.closed:
+            # 还回来的连接不应该带着未结束的事务
+            if conn._db.in_transaction:
+                conn.close()
+            elif self._closed:
+                conn.close()
+            else:
+                self._free.append(conn)
+        async with self._cond:
+            self._cond.notify()
+
+    def get(self):
+        return _PoolContext(self)
+
+    async def clear(self):
+        async with self._cond:
+            while self._free:
+                self._free.pop().close()
+            self._cond.notify_all()
+
+    def close(self):
+        self._closed = True
+
+    async def wait_closed(self):
+        for conn in self._free:
+            conn.close()
+        self._free = []
+
+
+class _PoolContext(object):
+    def __init__(self, pool):
+        self._pool = pool
+        self._conn = None
+
+    async def __aenter__(self):
+        self._conn = await self._pool.acquire()
+        return self._conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._pool.release(self._conn)
+
+
+async def create_pool(db, minsize=1, maxsize=5, loop=None, **kwargs):
+    '''open a pool of sqlite connections to the database file db.'''
+    pool = Pool(db, minsize, maxsize, loop or asyncio.get_event_loop())
+    await pool._fill()
+    return pool
@@ -0,0 +1,123 @@
+'''
+Create tables and indexes from the models in model.py, and check them against the live database.
+
+Usage:
+    python3 schema.py sql      print CREATE TABLE statements for every model
+    python3 schema.py apply    create missing tables and indexes
+    python3 schema.py check    report declared indexes missing from the database and query patterns no index serves
+
+check finds the query patterns by scanning the source files next to this one for Model.findall/iterate/
+findNumber/removeall/load calls whose where template (or load column) is a string literal.
+'''
+import os, ast, sys, asyncio, logging
+import orm, model
+from config import configs
+from orm import Model
+
+__author__ = 'cjh'
+
+
+# model.py中定义的所有Model
+def all_models():
+    return [v for v in vars(model).values() if isinstance(v, type) and issubclass(v, Model) and v is not Model]
+
+
+# 各查询方法的where参数（load是列名参数）的位置和关键字名
+_QUERY_ARGS = dict(findall=(1, 'where'), iterate=(0, 'where'), findNumber=(1, 'where'), removeall=(0, 'where'), load=(1, 'column'))
+
+
+def _literal(node):
+    return node.value if isinstance(node, ast.Constant) and isinstance(node.value, str) else None
+
+
+def query_patterns(paths=None):
+    '''statically collect the query patterns in the source files, as {model name: [(where, orderBy)]}.'''
+    if paths is None:
+        here = os.path.dirname(os.path.abspath(__file__))
+        paths = [os.path.join(here, f) for f in sorted(os.listdir(here)) if f.endswith('.py')]
+    patterns = dict()
+    for path in paths:
+        try:
+            with open(path, encoding='utf-8') as f:
+                tree = ast.parse(f.read(), path)
+        except (OSError, SyntaxError, ValueError):
+            # 不能按python3解析的文件（如python2写的第三方模块）跳过
+            continue
+        for node in ast.walk(tree):
+            if not (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+                    and isinstance(node.func.value, ast.Name) and node.func.attr in _QUERY_ARGS):
+                continue
+            pos, name = _QUERY_ARGS[node.func.attr]
+            kw = dict((k.arg, k.value) for k in node.keywords if k.arg)
+            arg = kw.get(name, node.args[pos] if len(node.args) > pos else None)
+            value = _literal(arg) if arg is not None else None
+            if value is None:
+                continue
+            where = '`%s`=?' % value if node.func.attr == 'load' else value
+            orderBy = _literal(kw['orderBy']) if 'orderBy' in kw else None
+            patterns.setdefault(node.func.value.id, []).append((where, orderBy))
+    return patterns
+
+
+def print_sql():
+    orm.use_backend(configs.database.get('backend', 'mysql'))
+    for m in all_models():
+        print('%s;\n' % orm.create_table_sql(m))
+        # SQLite的索引不能写在create table里
+        if orm.backend() == 'sqlite':
+            for index in m.__indexes__:
+                print('%s;\n' % orm.create_index_sql(m, index))
+
+
+async def apply():
+    for m in all_models():
+        await orm.execute(orm.create_table_sql(m), None)
+        live = await orm.live_indexes(m)
+        live_columns = [columns for columns, unique in live.values()]
+        for index in m.__indexes__:
+            if index[0] not in live and index[1] not in live_columns:
+                sql = orm.create_index_sql(m, index)
+                print(sql)
+                await orm.execute(sql, None)
+
+
+async def check():
+    ok = True
+    patterns = query_patterns()
+    for m in all_models():
+        live = await orm.live_indexes(m)
+        if not live:
+            print('%s: table does not exist' % m.__table__)
+            ok = False
+            continue
+        live_columns = [columns for columns, unique in live.values()]
+        for name, columns, unique in m.__indexes__:
+            if name not in live and columns not in live_columns:
+                print('%s: declared index %s (%s) is missing' % (m.__table__, name, ', '.join(columns)))
+                ok = False
+        for columns in orm.missing_indexes(m, live, patterns.get(m.__name__, ())):
+            print('%s: no index serves queries on (%s)' % (m.__table__, ', '.join(columns)))
+            ok = False
+    if ok:
+        print('schema ok')
+
+
+async def main(loop, cmd):
+    await orm.create_pool(loop, **configs.database)
+    try:
+        await (apply() if cmd == 'apply' else check())
+    finally:
+        await orm.close_pool()
+
+
+if __name__ == '__main__':
+    argv = sys.argv[1:]
+    if not argv or argv[0] not in ('sql', 'apply', 'check'):
+        print(__doc__)
+        exit(0)
+    if argv[0] == 'sql':
+        print_sql()
+        exit(0)
+    logging.getLogger().setLevel(logging.WARNING)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(loop, argv[0]))
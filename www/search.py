@@ -0,0 +1,364 @@
+'''
+Full-text search over blog title, summary and content.
+
+An in-process inverted index (term -> {blog id: weighted term frequency}) ranked with BM25.
+Latin text is split into words, CJK text into single characters and overlapping bigrams,
+so Chinese queries work without a word segmenter.
+
+The index is kept up to date by the blog create/update/delete handlers. Every change is appended
+to a journal next to the snapshot file, and the snapshot is rewritten every interval seconds,
+so a restart loads the snapshot, replays the journal and never has to scan the blogs table again.
+
+The index lives in one process and is updated only by the blog changes made through that process.
+open() takes an exclusive lock on path + '.lock', so a second process opening the same path fails
+instead of interleaving journals; give every process its own path. To pick up what other processes
+wrote, open() reconciles a loaded snapshot with the database (blogs added or deleted elsewhere), and
+with refresh set the index is rebuilt from the database every refresh seconds, which also picks up
+blogs edited elsewhere.
+'''
+import os, re, json, gzip, math, time, heapq, asyncio, logging
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+__author__ = 'cjh'
+
+# 日文假名、中日韩统一表意文字及扩展A、兼容表意文字、韩文音节
+_CJK = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af'
+_RE_TOKEN = re.compile('([%s]+)|([^\\W_%s]+)' % (_CJK, _CJK))
+
+# BM25参数
+K1 = 1.2
+B = 0.75
+
+# 标题里出现一次相当于正文里出现三次
+WEIGHTS = (('title', 3), ('summary', 2), ('content', 1))
+
+
+def tokenize(text, query=False):
+    '''split text into index terms: lower-cased words, and CJK characters plus overlapping bigrams.
+
+    Documents index both the characters and the bigrams of a CJK run; a query uses only the bigrams
+    (or the character when the run is a single character), so multi-character queries stay precise.
+    '''
+    for m in _RE_TOKEN.finditer((text or '').lower()):
+        run = m.group(1)
+        if run is None:
+            yield m.group(2)
+            continue
+        if len(run) == 1 or not query:
+            for c in run:
+                yield c
+        for i in range(len(run) - 1):
+            yield run[i:i+2]
+
+
+class SearchIndex(object):
+    def __init__(self, weights=WEIGHTS):
+        self.weights = weights
+        # term -> {doc_id: 加权词频}
+        self.postings = {}
+        # doc_id -> (文档长度, {term: 加权词频})，删除和更新文档时用来找到它的所有term
+        self.docs = {}
+        self.total_length = 0
+        self.path = None
+        self.interval = 30
+        self._journal = None
+        self._dirty = False
+        self._task = None
+        self._refresher = None
+        self._saving = None
+        self._lock = None
+        self.refresh = 0
+        # 后台重建期间本进程的修改，重建完成后补到新索引上
+        self._changes = None
+
+    def __len__(self):
+        return len(self.docs)
+
+    def _terms(self, fields):
+        terms = {}
+        for name, weight in self.weights:
+            for t in tokenize(fields.get(name)):
+                terms[t] = terms.get(t, 0) + weight
+        return terms
+
+    def _put(self, doc_id, length, terms):
+        self._remove(doc_id)
+        for t, tf in terms.items():
+            self.postings.setdefault(t, {})[doc_id] = tf
+        self.docs[doc_id] = (length, terms)
+        self.total_length += length
+
+    def _remove(self, doc_id):
+        doc = self.docs.pop(doc_id, None)
+        if doc is None:
+            return False
+        length, terms = doc
+        for t in terms:
+            ps = self.postings.get(t)
+            if ps is not None:
+                ps.pop(doc_id, None)
+                if not ps:
+                    del self.postings[t]
+        self.total_length -= length
+        return True
+
+    def put(self, doc_id, **fields):
+        '''index (or re-index) one document from its text fields.'''
+        terms = self._terms(fields)
+        length = sum(terms.values())
+        self._put(doc_id, length, terms)
+        self._log(dict(op='put', id=doc_id, len=length, terms=terms))
+
+    def remove(self, doc_id):
+        if self._remove(doc_id):
+            self._log(dict(op='del', id=doc_id))
+
+    def search(self, query, offset=0, limit=10, budget=None):
+        '''rank the documents containing every query term.
+
+        Returns dict(total, hits=[(doc_id, score)], partial, took). The smallest posting list drives
+        the scan; when budget (seconds) runs out the scan stops and the result is marked partial,
+        ranked over the documents seen so far.
+        '''
+        start = time.monotonic()
+        terms = list(dict.fromkeys(tokenize(query, query=True)))
+        lists = [(self.postings.get(t), t) for t in terms]
+        if not terms or any(ps is None for ps, t in lists):
+            return dict(total=0, hits=[], partial=False, took=time.monotonic() - start)
+        lists.sort(key=lambda x: len(x[0]))
+        n = len(self.docs)
+        avgdl = self.total_length / n if n else 1.0
+        idfs = [math.log(1 + (n - len(ps) + 0.5) / (len(ps) + 0.5)) for ps, t in lists]
+        docs = self.docs
+        scored = []
+        partial = False
+        for i, doc_id in enumerate(lists[0][0]):
+            # 每256个文档检查一次时间预算
+            if budget and not i & 255 and i and time.monotonic() - start > budget:
+                partial = True
+                break
+            norm = K1 * (1 - B + B * docs[doc_id][0] / avgdl)
+            score = 0.0
+            for (ps, t), idf in zip(lists, idfs):
+                tf = ps.get(doc_id)
+                if tf is None:
+                    break
+                score += idf * tf * (K1 + 1) / (tf + norm)
+            else:
+                scored.append((score, doc_id))
+        # 分数相同时id大（更新）的排在前面
+        hits = heapq.nlargest(offset + limit, scored)[offset:]
+        return dict(total=len(scored), hits=[(doc_id, score) for score, doc_id in hits], partial=partial, took=time.monotonic() - start)
+
+    # 持久化：快照文件 + 追加写的日志
+
+    def _log(self, entry):
+        self._dirty = True
+        if self._changes is not None:
+            self._changes.append(entry)
+        if self._journal is not None:
+            self._journal.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            self._journal.flush()
+
+    def _apply(self, entry):
+        if entry['op'] == 'put':
+            self._put(entry['id'], entry['len'], entry['terms'])
+        else:
+            self._remove(entry['id'])
+
+    def _replay(self, path):
+        n = 0
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # 崩溃时写了一半的行
+                    continue
+                self._apply(entry)
+                n += 1
+        # 重放过日志就重写一次快照，把日志合并进去
+        self._dirty = self._dirty or n > 0
+        return n
+
+    def _load(self, path):
+        loaded = False
+        if os.path.exists(path):
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                for doc_id, (length, terms) in json.load(f)['docs'].items():
+                    self._put(doc_id, length, terms)
+            loaded = True
+        # .log.old是上次写快照时被换下的日志，快照没写完就退出时它还在；重放是幂等的
+        for log in (path + '.log.old', path + '.log'):
+            if os.path.exists(log):
+                logging.info('search index: replayed %s entries from %s' % (self._replay(log), log))
+                loaded = True
+        return loaded
+
+    # 快照和日志只能由一个进程读写，用文件锁保证；没有fcntl的平台（Windows）不加锁
+    def _acquire(self, path):
+        if fcntl is None:
+            return
+        f = open(path + '.lock', 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            raise RuntimeError('search index %s is in use by another process, give every process its own search path' % path)
+        self._lock = f
+
+    async def open(self, path, rebuild=None, interval=30, reconcile=None, refresh=0):
+        '''load the index from path, or build it with the coroutine function rebuild(index) when there is nothing on disk.
+
+        A loaded index is brought up to date with the coroutine function reconcile(index); with refresh
+        (seconds) set, it is rebuilt in the background with rebuild(index) that often.
+        Raises RuntimeError when another process has the index at path open.
+        '''
+        loop = asyncio.get_event_loop()
+        self._acquire(path)
+        self.path = path
+        self.interval = interval
+        self.refresh = refresh
+        start = time.time()
+        if await loop.run_in_executor(None, self._load, path):
+            logging.info('search index: loaded %s documents in %.3fs' % (len(self.docs), time.time() - start))
+            if reconcile is not None:
+                await reconcile(self)
+        elif rebuild is not None:
+            await rebuild(self)
+            self._dirty = True
+            logging.info('search index: built from database, %s documents in %.3fs' % (len(self.docs), time.time() - start))
+        self._journal = open(path + '.log', 'a', encoding='utf-8')
+        if self._dirty:
+            await self.save()
+        if interval and self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+        if refresh and rebuild is not None and self._refresher is None:
+            self._refresher = asyncio.ensure_future(self._refresh_loop(rebuild))
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if self._dirty:
+                try:
+                    await self.save()
+                except Exception as e:
+                    logging.exception(e)
+
+    async def _refresh_loop(self, rebuild):
+        while True:
+            await asyncio.sleep(self.refresh)
+            try:
+                await self.reload(rebuild)
+            except Exception as e:
+                logging.exception(e)
+
+    async def reload(self, rebuild):
+        '''rebuild the index from the database with rebuild(index) and swap it in; searches use the old index meanwhile.'''
+        start = time.time()
+        fresh = SearchIndex(self.weights)
+        self._changes = []
+        try:
+            await rebuild(fresh)
+            # 重建期间本进程的修改可能没有被读到，按顺序补上
+            for entry in self._changes:
+                fresh._apply(entry)
+        finally:
+            self._changes = None
+        self.postings, self.docs, self.total_length = fresh.postings, fresh.docs, fresh.total_length
+        self._dirty = True
+        logging.info('search index: refreshed from database, %s documents in %.3fs' % (len(self.docs), time.time() - start))
+
+    def _write(self, docs):
+        tmp = self.path + '.tmp'
+        with gzip.open(tmp, 'wt', encoding='utf-8', compresslevel=1) as f:
+            json.dump(dict(version=1, docs=docs), f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp, self.path)
+        try:
+            os.remove(self.path + '.log.old')
+        except FileNotFoundError:
+            pass
+
+    async def save(self):
+        '''write a snapshot and truncate the journal; the file is written in a worker thread.'''
+        if self.path is None:
+            return
+        if self._saving is not None:
+            return await asyncio.shield(self._saving)
+        # 文档的term字典更新时整体替换、不会原地修改，浅拷贝后就可以在线程里序列化
+        docs = dict(self.docs)
+        self._dirty = False
+        if self._journal is not None:
+            # 换下旧日志，快照写完后删除；快照之后的修改写进新日志
+            self._journal.close()
+            old = self.path + '.log.old'
+            if os.path.exists(old):
+                # 上一次快照没有写完，把当前日志接在旧日志后面，这次快照写完前两部分都不能丢
+                with open(old, 'a', encoding='utf-8') as dst, open(self.path + '.log', encoding='utf-8') as src:
+                    dst.write(src.read())
+                os.remove(self.path + '.log')
+            else:
+                os.replace(self.path + '.log', old)
+            self._journal = open(self.path + '.log', 'a', encoding='utf-8')
+        self._saving = asyncio.get_event_loop().run_in_executor(None, self._write, docs)
+        try:
+            await self._saving
+        except Exception:
+            self._dirty = True
+            raise
+        finally:
+            self._saving = None
+
+    async def close(self):
+        if self._refresher is not None:
+            self._refresher.cancel()
+            self._refresher = None
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._dirty:
+            await self.save()
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        if self._lock is not None:
+            # 关闭文件即释放锁
+            self._lock.close()
+            self._lock = None
+
+
+blog_index = SearchIndex()
+
+def index_blog(blog):
+    # 关于页面也是一篇博客，不参与搜索
+    if blog.title == '__about__':
+        blog_index.remove(blog.id)
+    else:
+        blog_index.put(blog.id, title=blog.title, summary=blog.summary, content=blog.content)
+
+async def rebuild_blog_index(index):
+    from model import Blog
+    async for blogs in Blog.iterate(batch=200):
+        for blog in blogs:
+            if blog.title != '__about__':
+                index.put(blog.id, title=blog.title, summary=blog.summary, content=blog.content)
+
+# 启动时加载的快照里没有其他进程新建的博客，也可能还有其他进程删掉的博客，按id与数据库对齐
+# 只比较id，其他进程对已有博客的修改要靠refresh定时重建
+async def reconcile_blog_index(index):
+    from model import Blog
+    start = time.time()
+    ids = set(b.id for b in await Blog.findall(col=['id'], where='title<>?', args=['__about__'], compact=True))
+    removed = [doc_id for doc_id in index.docs if doc_id not in ids]
+    for doc_id in removed:
+        index.remove(doc_id)
+    missing = [doc_id for doc_id in ids if doc_id not in index.docs]
+    for i in range(0, len(missing), 200):
+        chunk = missing[i:i+200]
+        for blog in await Blog.findall(where='id in (%s)' % ', '.join(['?'] * len(chunk)), args=chunk, undefer=True):
+            index.put(blog.id, title=blog.title, summary=blog.summary, content=blog.content)
+    logging.info('search index: reconciled with database, %s added, %s removed in %.3fs' % (len(missing), len(removed), time.time() - start))
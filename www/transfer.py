@@ -0,0 +1,191 @@
+'''
+Export every model to compressed JSON lines and import it back, in constant memory.
+
+Usage:
+    python3 transfer.py export FILE [table ...]   dump the tables (default: all models), FILE ending in .gz or .zst
+    python3 transfer.py import FILE               load FILE, an interrupted import resumes from FILE.ckpt
+
+The file is a header line {"table": ..., "columns": [...]} followed by one JSON array per row, for each table.
+Rows are read over a server-side cursor and written in batches; import inserts them in batches with
+REPLACE INTO, so replaying rows after a crash is harmless, and records the line it reached in a checkpoint
+file after every committed batch. Tables are read one after another, not as one consistent snapshot.
+'''
+import os, io, sys, json, zlib, gzip, time, asyncio, logging
+import orm, schema
+from config import configs
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+__author__ = 'cjh'
+
+
+def file_format(path):
+    return 'zst' if path.endswith('.zst') else 'gz'
+
+
+def compressor(fmt):
+    if fmt == 'zst':
+        if zstandard is None:
+            raise ValueError('zstd compression needs the zstandard package')
+        return zstandard.ZstdCompressor(level=3).compressobj()
+    # wbits=31：带gzip文件头，与gzip.open读写的格式相同
+    return zlib.compressobj(6, zlib.DEFLATED, 31)
+
+
+def open_lines(path):
+    '''open an export file for reading decompressed lines.'''
+    if file_format(path) == 'zst':
+        if zstandard is None:
+            raise ValueError('zstd compression needs the zstandard package')
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb')))
+    return gzip.open(path, 'rb')
+
+
+# 按表名或类名选出要导出的Model，不指定时导出model.py中的全部Model
+def select_models(names=None):
+    models = schema.all_models()
+    if not names:
+        return models
+    found = []
+    for name in names:
+        m = [m for m in models if name in (m.__table__, m.__name__)]
+        if not m:
+            raise ValueError('unknown model: %s' % name)
+        found.append(m[0])
+    return found
+
+
+async def export_lines(models, batch=500):
+    '''yield the export as text, one chunk of lines per batch of rows.'''
+    for m in models:
+        columns = [m.__primary_key__] + m.__fields__
+        yield json.dumps(dict(table=m.__table__, columns=columns), ensure_ascii=False) + '\n'
+        n = 0
+        async for rs in orm.iterate(m.__select__, None, batch):
+            yield ''.join([json.dumps([r[c] for c in columns], ensure_ascii=False, default=str) + '\n' for r in rs])
+            n += len(rs)
+        logging.info('export: %s rows from %s' % (n, m.__table__))
+
+
+async def export_stream(models, fmt='gz', batch=500):
+    '''yield the compressed export, for writing to a file or an HTTP response.'''
+    z = compressor(fmt)
+    async for text in export_lines(models, batch):
+        data = z.compress(text.encode('utf-8'))
+        if data:
+            yield data
+    yield z.flush()
+
+
+async def export_file(path, names=None, batch=500):
+    '''write the export to path; the file only appears once it is complete.'''
+    tmp = path + '.tmp'
+    size = 0
+    with open(tmp, 'wb') as f:
+        async for data in export_stream(select_models(names), file_format(path), batch):
+            f.write(data)
+            size += len(data)
+    os.replace(tmp, path)
+    return size
+
+
+# 断点文件记录导入文件的大小和已经提交到的行号，文件变了就从头导入
+def _read_checkpoint(path):
+    try:
+        with open(path + '.ckpt') as f:
+            ckpt = json.load(f)
+    except (OSError, ValueError):
+        return 0
+    return ckpt['line'] if ckpt.get('size') == os.path.getsize(path) else 0
+
+
+def _write_checkpoint(path, line):
+    tmp = path + '.ckpt.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(dict(size=os.path.getsize(path), line=line), f)
+    os.replace(tmp, path + '.ckpt')
+
+
+async def import_file(path, batch=500):
+    '''load an export file into the database, resuming after the last committed batch of an earlier run.
+
+    Returns dict(rows=imported rows, resumed=line the import resumed after, tables=[imported models]).
+    '''
+    models = dict((m.__table__, m) for m in schema.all_models())
+    resumed = _read_checkpoint(path)
+    if resumed:
+        logging.info('import: resuming %s after line %s' % (path, resumed))
+    model = columns = sql = None
+    tables = []
+    rows = []
+    total = 0
+    line_no = 0
+
+    async def flush():
+        nonlocal total
+        if rows:
+            await orm.execute_many(sql, rows, batch)
+            orm.invalidate(model.__table__)
+            total += len(rows)
+            del rows[:]
+        if line_no > resumed:
+            _write_checkpoint(path, line_no)
+
+    with open_lines(path) as f:
+        for line in f:
+            # 表头是对象，数据行是数组
+            if line.startswith(b'{'):
+                await flush()
+                line_no += 1
+                header = json.loads(line)
+                model = models.get(header['table'])
+                if model is None:
+                    raise ValueError('line %s: unknown table %s' % (line_no, header['table']))
+                columns = [c for c in header['columns'] if c in model.__mappings__]
+                index = [header['columns'].index(c) for c in columns]
+                # 导入文件中的行可能已经存在，REPLACE INTO覆盖同主键的行，中断后重放也不会冲突
+                sql = 'replace' + model.__insert__[len('insert'):]
+                tables.append(model)
+                continue
+            line_no += 1
+            if line_no <= resumed:
+                continue
+            values = json.loads(line)
+            # 导出时没有的列（较新的Model加的字段）取默认值
+            obj = model(**dict((c, values[i]) for c, i in zip(columns, index)))
+            rows.append(model.__insert_args__(obj))
+            if len(rows) >= batch:
+                await flush()
+        await flush()
+    if os.path.exists(path + '.ckpt'):
+        os.remove(path + '.ckpt')
+    await orm.rebuild_counters(*tables)
+    logging.info('import: %s rows from %s' % (total, path))
+    return dict(rows=total, resumed=resumed, tables=tables)
+
+
+async def main(loop, cmd, path, names):
+    await orm.create_pool(loop, **configs.database)
+    try:
+        start = time.time()
+        if cmd == 'export':
+            size = await export_file(path, names, configs.transfer.batch)
+            print('exported %s bytes to %s in %.1fs' % (size, path, time.time() - start))
+        else:
+            r = await import_file(path, configs.transfer.batch)
+            print('imported %s rows (resumed after line %s) in %.1fs' % (r['rows'], r['resumed'], time.time() - start))
+    finally:
+        await orm.close_pool()
+
+
+if __name__ == '__main__':
+    argv = sys.argv[1:]
+    if len(argv) < 2 or argv[0] not in ('export', 'import'):
+        print(__doc__)
+        exit(0)
+    logging.getLogger().setLevel(logging.WARNING)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(loop, argv[0], argv[1], argv[2:]))
@@ -1,10 +1,11 @@
 _author_ = 'cjh'
 
-import os, json, time, hashlib
+import os, json, time, base64, hashlib
 import inspect
 import logging
 import functools
 import asyncio
+import orm
 from urllib import parse
 from aiohttp import web
 from apis import APIError
@@ -268,7 +269,26 @@ async def logger_factory(app, handler):
     async def logger_middleware(request):
         logging.info('Request: %s %s ' % (request.method, request.path))
         return await handler(request)
-    return logger_middleware()
+    return logger_middleware
+
+# 每个请求的数据库时间预算：请求里的所有查询共用request_timeout秒，超时返回503
+async def deadline_factory(app, handler):
+    async def deadline_middleware(request):
+        if request.path.startswith('/static'):
+            return await handler(request)
+        try:
+            with orm.deadline(configs.database.request_timeout):
+                return await handler(request)
+        except orm.QueryTimeout as e:
+            logging.warning('%s %s: %s' % (request.method, request.path, e))
+            return web.HTTPServiceUnavailable()
+    return deadline_middleware
+
+# json.dumps无法直接序列化的对象：紧凑行对象转成dict，其他对象（如Page）取__dict__
+def json_default(o):
+    if isinstance(o, orm.Row):
+        return o.to_dict()
+    return o.__dict__
 
 async def response_factory(app, handler):
     async def response_middleware(request):
@@ -289,7 +309,7 @@ async def response_factory(app, handler):
         if isinstance(r, dict):
             template = r.get('__template__')
             if template is None:
-                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o:o.__dict__).encode('utf-8'))
+                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=json_default).encode('utf-8'))
                 return resp
             else:
                 resp = web.Response(body=app['__template__'].get_template(template).render(**r).encode('utf-8'))
@@ -312,16 +332,20 @@ async def auth_factory(app, handler):
         if not request.path.startswith('/static'):
             logging.info('check user: %s %s '%(request.method, request.path))
             request.__user__ = None
+            # 本次请求内Model.load的批量查询和结果缓存
+            orm.bind_loaders()
             cookie_str = request.cookies.get(configs.cookie.name)
             if cookie_str:
                 user = await cookie2user(cookie_str)
                 if user:
                     logging.info('set current user:%s'%user.email)
                     request.__user__ = user
+            # 读写分离：登录用户按用户id跟踪最近的写操作，匿名请求只在本次请求内保证读到自己的写入
+            orm.bind_session(request.__user__.id if request.__user__ else object())
             if request.path.startswith('/manage') and (request.__user__ is None or (not configs.show_manage_page and not request.__user__.admin)):
                 return web.HTTPFound('/login')
         return await handler(request)
-    return auth_middleware()
+    return auth_middleware
 
 def user2cookie(user, max_age):
     expires = str(int(time.time() + max_age))
@@ -339,19 +363,36 @@ async def cookie2user(cookie_str):
         uid, expires, sha1 = L
         if int(expires) < time.time():
             return None
-        user = await User.find(uid)
+        user = await User.load(uid)
         if user is None:
             return None
-        s = '%s-%s-%s-%s'%(uid, user.password, expires, configs.cookie.key)
+        s = '%s-%s-%s-%s'%(uid, user.passwd, expires, configs.cookie.key)
         if sha1 != hashlib.sha1(s.encode('utf-8')).hexdigest():
             logging.info('invalid sha1')
             return None
-        user.password = '******'
+        # User.load返回本次请求共用的对象，绕过脏字段记录屏蔽密码，之后对它的update()不会把'******'写进数据库
+        dict.__setitem__(user, 'passwd', '******')
         return user
     except Exception as e:
         logging.exception(e)
         return None
 
+# 并发获取页面需要的互不依赖的数据，每个查询从连接池各借一个连接，页面耗时从各查询之和变成其中最慢的一个
+# data = await gather_page(cats=Category.findall(...), blog=Blog.find(id))，返回以参数名为键的dict
+# 任何一个失败时取消其余的查询再抛出异常；查询在子任务中执行，继承请求的截止时间和会话
+async def gather_page(**needs):
+    names = list(needs)
+    tasks = [asyncio.ensure_future(needs[name]) for name in names]
+    try:
+        results = await asyncio.gather(*tasks)
+    except BaseException:
+        for t in tasks:
+            t.cancel()
+        # 等被取消的查询把连接还回池里
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    return dict(zip(names, results))
+
 # 用于分页
 class Page(object):
     """docstring for Page"""
@@ -394,6 +435,17 @@ class Page(object):
 
     __repr__ = __str__
 
+    # 上一页、下一页的链接，url为'?page='这样的前缀
+    def prev_url(self, url):
+        return '%s%s' % (url, self.page_index - 1)
+
+    def next_url(self, url):
+        return '%s%s' % (url, self.page_index + 1)
+
+    # 是否显示末页的页码链接
+    def show_last(self):
+        return True
+
 
     @classmethod
     def page2int(cls, str):
@@ -419,6 +471,78 @@ class Page(object):
                 left = right - self.page_show
         self.pagelist = list(range(left, right))
 
+# 游标是(created_at, id, 页码)的json再做urlsafe base64，对页面来说是不透明的字符串
+def encode_cursor(item, page_index):
+    s = json.dumps([item.created_at, item.id, page_index])
+    return base64.urlsafe_b64encode(s.encode('utf-8')).decode('ascii').rstrip('=')
+
+# 游标来自url，可能被篡改：created_at不是数字、id不是字符串或页码小于1时当作无效游标，回到按页码分页
+def decode_cursor(cursor):
+    try:
+        s = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        created_at, id, page_index = json.loads(s)
+    except (ValueError, TypeError):
+        return None, None
+    if isinstance(created_at, bool) or not isinstance(created_at, (int, float)) or not isinstance(id, str):
+        return None, None
+    if isinstance(page_index, bool) or not isinstance(page_index, int) or page_index < 1:
+        return None, None
+    return (created_at, id), page_index
+
+# keyset分页：前offset_pages页仍然按页码（LIMIT offset, n）访问，
+# 上一页、下一页通过before/after游标定位，翻到多深都只扫描一页的行数
+class SeekPage(Page):
+    def __init__(self, item_count, page_index = 1, page_size = 10, page_show = 3, offset_pages = 10, after = None, before = None):
+        self.after = self.before = None
+        key, index = decode_cursor(after or before) if (after or before) else (None, None)
+        # 游标的页码超出了总页数（比如条目被删掉了）也回到按页码分页
+        page_count = item_count // page_size + (1 if item_count % page_size > 0 else 0)
+        if key is not None and index <= page_count:
+            page_index = index
+            if after:
+                self.after = key
+            else:
+                self.before = key
+        super(SeekPage, self).__init__(item_count, page_index, page_size, page_show)
+        self.offset_pages = offset_pages
+        self.prev_cursor = None
+        self.next_cursor = None
+
+    # 传给Model.findall的分页参数
+    def query(self):
+        if self.after is not None:
+            return dict(after=self.after, limit=self.limit)
+        if self.before is not None:
+            return dict(before=self.before, limit=self.limit)
+        return dict(limit=(self.offset, self.limit))
+
+    # 根据本页第一条和最后一条记录生成上一页、下一页的游标
+    def set_items(self, items):
+        if not items:
+            return
+        if self.has_previous:
+            self.prev_cursor = encode_cursor(items[0], self.page_index - 1)
+        if self.has_next:
+            self.next_cursor = encode_cursor(items[-1], self.page_index + 1)
+
+    def prev_url(self, url):
+        if self.prev_cursor:
+            return '?before=%s' % self.prev_cursor
+        return Page.prev_url(self, url)
+
+    def next_url(self, url):
+        if self.next_cursor:
+            return '?after=%s' % self.next_cursor
+        return Page.next_url(self, url)
+
+    def show_last(self):
+        return self.page_count <= self.offset_pages
+
+    def pagelist(self):
+        Page.pagelist(self)
+        # 只有靠前的页用页码访问，深处只显示当前页
+        self.pagelist = [p for p in self.pagelist if p <= self.offset_pages or p == self.page_index]
+
 def filelist(dir):
     filelist = []
     l = os.listdir(dir)